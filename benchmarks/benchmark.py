@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+#
+# benchmark
+#
+# Time the rankMotif pipeline and each of its stages on the datasets
+# bundled in tests/ and on synthetically scaled-up copies of them, and
+# compare the results with a JSON baseline.
+#
+# Every dataset is run twice, each time in a fresh process: once
+# through the pipeline as rankMotif.py runs it (wall time and peak RSS
+# of the whole run), and once stage by stage:
+#
+#     load            Dataset (FASTA and base score parsing)
+#     matchtables     build_matchtables of the pattern list
+#     scoring         PatternScoring.build
+#     cluster         Cluster.run
+#     collect         collect_results
+#     output          write_results
+#
+# and, each run on its own after the stage they belong to:
+#
+#     scoring.preferential_occurrence, scoring.position,
+#     scoring.occupancy, scoring.conservation,
+#     collect.merge_patterns, collect.extract_match_info, collect.pfm
+#
+# No conservation scores are bundled: ACE2_YPD feeds its nucleosome
+# occupancy file in as -cs as well (oc-as-cs), so scoring.conservation
+# times the conservation scoring code on occupancy values and says
+# nothing about real conservation data.
+#
+# Every stage is reported with its wall time, the peak RSS of the
+# process at its end and its throughput. The PFM of every cluster is
+# compared with the expected PFMs of the dataset (*.ans*.pfm.txt) by
+# simpfm; the best similarity must not drop below the baseline.
+#
+# A scale of k replicates the sequence sets (and the base scores) k
+# times and extends the pattern list to k times as many patterns. The
+# copies of the sequences get 2% random substitutions and the new
+# patterns are sampled from the positive set with the wildcards of the
+# listed ones; both are seeded, so a scaled dataset is the same in
+# every run. Scales of 10 and 100 take from minutes to hours.
+#
+# Usage:
+#
+#     python benchmarks/benchmark.py -save benchmarks/baseline.json
+#     python benchmarks/benchmark.py -baseline benchmarks/baseline.json
+#     python benchmarks/benchmark.py -datasets DIG1_YPD -scales 1 10
+#
+# No baseline is committed. Save one with the first command on the
+# host that runs the comparisons, with the -engine, -cpu and -compact
+# options the comparisons use, and save it again after a change of
+# the host or of this script.
+#
+# The exit status is 1 when a stage is slower or larger than the
+# baseline by more than -tolerance, or an expected PFM is less similar.
+# A baseline saved with other -engine, -cpu or -compact options, or by
+# another version of this script, is rejected. Wall times and peak RSS
+# depend on the machine: they are only compared when the baseline was
+# saved on the same host (name, architecture and Python version), and
+# elsewhere only the PFM similarities are.
+#
+# Author: Jian-Long Huang <jianlong@ntu.edu.tw>
+
+import os
+import sys
+import json
+import time
+import platform
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import traceback
+from multiprocessing import Pipe, Process
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rankmotif.basic import Pattern, PatternSet, merge_patterns
+from rankmotif.indexing import build_matchtables
+from rankmotif.scoring import (PreferentialOccurrence, PositionScoring,
+                               NucleosomeOccupancyScoring, ConservationScoring,
+                               PatternScoring)
+from rankmotif.ranking import Cluster
+from rankmotif.pfm import pfm, simpfm_array
+from rankmotif.pipeline import Dataset, rank, collect_results, write_results
+from rankmotif.seqio import parse_fasta, gc_content
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests')
+
+# Options of the bundled datasets
+DATASETS = {
+    'ABF1_YPD': {
+        'oc': True,
+        'cs': False,
+        'seqmask': False,
+        'ws': None,
+    },
+    'ACE2_YPD': {
+        'oc': True,
+        # The occupancy file again (oc-as-cs); no conservation scores are
+        # bundled
+        'cs': True,
+        'seqmask': False,
+        'ws': None,
+    },
+    'DIG1_YPD': {
+        'oc': False,
+        'cs': False,
+        'seqmask': True,
+        'ws': 7,
+    },
+}
+
+# Bumped whenever the layout of the baseline changes
+BASELINE_VERSION = 2
+
+# Substitution rate of the sequence copies of a scaled dataset
+MUTATION_RATE = 0.02
+
+# Timing differences below this many seconds are never regressions
+MIN_TIME_DELTA = 0.05
+
+# Similarity differences below this are never regressions
+MIN_SIMILARITY_DELTA = 0.01
+
+
+def dataset_files(name, scale, workdir):
+    """Return the files of a dataset at a scale, as a dict of pset,
+    nset, plist, oc, cs and ans (a list of PFM files); the files of a
+    scaled dataset are written into workdir"""
+    prefix = os.path.join(TESTS_DIR, name, name)
+    score_file = prefix + '.pos.gene.fasta_histone.txt'
+    files = {
+        'pset': prefix + '.pos.gene.fasta',
+        'nset': prefix + '.neg.gene.fasta',
+        'plist': prefix,
+        'oc': score_file if DATASETS.get(name).get('oc') else None,
+        'cs': score_file if DATASETS.get(name).get('cs') else None,
+        'ans': sorted(os.path.join(TESTS_DIR, name, i)
+                      for i in os.listdir(os.path.join(TESTS_DIR, name))
+                      if i.startswith(name + '.ans') and i.endswith('.pfm.txt')),
+    }
+    if scale == 1:
+        return files
+
+    scaled = dict(files)
+    out = os.path.join(workdir, '{0}_x{1}'.format(name, scale))
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    pset_sequences = []
+    for key, seed in [('pset', 1), ('nset', 2)]:
+        fpath = os.path.join(out, os.path.basename(files.get(key)))
+        with open(files.get(key), 'r') as fi:
+            sequences = list(parse_fasta(fi))
+        write_scaled_fasta(sequences, fpath, scale, seed)
+        scaled.update({key: fpath})
+        if key == 'pset':
+            pset_sequences = sequences
+
+    if files.get('oc') or files.get('cs'):
+        fpath = os.path.join(out, os.path.basename(score_file))
+        write_scaled_scores(score_file, fpath, scale, len(pset_sequences))
+        scaled.update({
+            'oc': fpath if files.get('oc') else None,
+            'cs': fpath if files.get('cs') else None,
+        })
+
+    fpath = os.path.join(out, name)
+    with open(files.get('plist'), 'r') as fi:
+        sequences = [i.strip() for i in fi if i.strip()]
+    write_scaled_patterns(sequences, pset_sequences, fpath, scale, 3)
+    scaled.update({'plist': fpath})
+
+    return scaled
+
+
+def write_scaled_fasta(sequences, fpath, scale, seed):
+    """Write scale copies of the sequences; every copy after the first
+    gets random substitutions and the copy number in its gene names"""
+    random_state = np.random.RandomState(seed)
+    bases = np.array(list('ACGT'))
+    with open(fpath, 'w') as fo:
+        for copy in xrange(scale):
+            for gene_name, sequence in sequences:
+                if copy:
+                    gene_name = '{0}_{1}'.format(gene_name, copy)
+                    sequence = np.array(list(sequence))
+                    mutated = random_state.random_sample(len(sequence)) < MUTATION_RATE
+                    sequence[mutated] = bases[random_state.randint(4, size=mutated.sum())]
+                    sequence = ''.join(sequence)
+                fo.write('>{0}\n{1}\n'.format(gene_name, sequence))
+
+
+def write_scaled_scores(score_file, fpath, scale, n_seqs):
+    """Write the base scores of every copy of the positive set; the
+    seqids of copy k are shifted by k * n_seqs"""
+    with open(score_file, 'r') as fi:
+        lines = [i.rstrip('\n').split('\t') for i in fi if i.strip()]
+
+    with open(fpath, 'w') as fo:
+        for copy in xrange(scale):
+            for data in lines:
+                fo.write('\t'.join([str(int(data[0]) + copy * n_seqs)] + data[1:]))
+                fo.write('\n')
+
+
+def write_scaled_patterns(sequences, pset_sequences, fpath, scale, seed):
+    """Write the patterns followed by distinct patterns sampled from the
+    positive set, up to scale times as many patterns
+
+    A sampled pattern takes the wildcards of a listed pattern and the
+    other bases from a random window of a positive sequence, so it
+    occurs at least once, as a discovered pattern does."""
+    rng = random.Random(seed)
+    seen = set(i.lower() for i in sequences)
+    patterns = list(sequences)
+    target = len(sequences) * scale
+    attempts = 0
+    while len(patterns) < target and attempts < target * 100:
+        attempts += 1
+        template = rng.choice(sequences).lower()
+        gene_name, sequence = rng.choice(pset_sequences)
+        if len(sequence) < len(template):
+            continue
+        start = rng.randint(0, len(sequence) - len(template))
+        window = sequence[start: start + len(template)].lower()
+        if set(window) - set('acgt'):
+            continue
+        sequence = ''.join(['n' if i == 'n' else j for i, j in zip(template, window)])
+        if sequence not in seen:
+            seen.add(sequence)
+            patterns.append(sequence.upper())
+
+    with open(fpath, 'w') as fo:
+        for sequence in patterns:
+            fo.write(sequence + '\n')
+
+
+def read_pfm(fpath):
+    """Read a PFM file: a header line and the a, t, c and g rows"""
+    with open(fpath, 'r') as fi:
+        rows = [i.split() for i in fi if i.strip()]
+
+    return dict(zip(['a', 't', 'c', 'g'], [[float(j) for j in i] for i in rows[1:5]]))
+
+
+def peak_rss():
+    """Peak resident set size of the process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageTimer(object):
+    """Wall time, peak RSS and throughput of the stages of a run"""
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, func, *args, **kwargs):
+        """Run a stage and return the result of func
+
+        The throughput is counted by the 'count' function in kwargs,
+        which takes the result and returns (count, unit)"""
+        count = kwargs.pop('count', None)
+        start = time.time()
+        result = func(*args, **kwargs)
+        elapsed = time.time() - start
+
+        stage = {'name': name, 'time': elapsed, 'peak_rss_mb': peak_rss()}
+        if count is not None:
+            n, unit = count(result)
+            stage.update({
+                'throughput': n / elapsed if elapsed > 0 else None,
+                'unit': '{0}/s'.format(unit),
+            })
+        self.stages.append(stage)
+
+        return result
+
+
+def _pipeline_run(name, files, options, out):
+    start = time.time()
+    dataset = Dataset(files.get('pset'), files.get('nset'), oc=files.get('oc'), cs=files.get('cs'))
+    with open(files.get('plist'), 'r') as fi:
+        sequences = [i.strip() for i in fi]
+    cluster = rank(dataset, sequences, True, simpfm_max_wsize=DATASETS.get(name).get('ws'),
+                   seqmask=DATASETS.get(name).get('seqmask'), **options)
+    write_results(collect_results(cluster, dataset.pset, True), out)
+
+    return {'time': time.time() - start, 'peak_rss_mb': peak_rss()}
+
+
+def _staged_run(name, files, options, out):
+    seqmask = DATASETS.get(name).get('seqmask')
+    timer = StageTimer()
+
+    dataset = timer.run('load', Dataset, files.get('pset'), files.get('nset'),
+                        oc=files.get('oc'), cs=files.get('cs'),
+                        count=lambda x: (len(x.pset.data) + len(x.nset.data), 'bases'))
+
+    pattern_set = PatternSet(True)
+    with open(files.get('plist'), 'r') as fi:
+        for sequence in fi:
+            pattern_set.add(Pattern(sequence.strip()))
+    n_patterns = len(pattern_set)
+
+    timer.run('matchtables', build_matchtables, pattern_set, dataset.pset, dataset.nset,
+              count=lambda x: (n_patterns, 'patterns'), **options)
+
+    pattern_scoring = timer.run('scoring', PatternScoring().build, pattern_set, seqmask=seqmask,
+                                nuclocc=dataset.oc, consv=dataset.cs,
+                                count=lambda x: (n_patterns, 'patterns'))
+    timer.run('scoring.preferential_occurrence', PreferentialOccurrence().build, pattern_set,
+              count=lambda x: (n_patterns, 'patterns'))
+    timer.run('scoring.position', PositionScoring().build, pattern_set, seqmask=seqmask,
+              count=lambda x: (n_patterns, 'patterns'))
+    if dataset.oc:
+        timer.run('scoring.occupancy', NucleosomeOccupancyScoring().build, pattern_set,
+                  score_file=dataset.oc, count=lambda x: (n_patterns, 'patterns'))
+    if dataset.cs:
+        timer.run('scoring.conservation', ConservationScoring().build, pattern_set,
+                  score_file=dataset.cs, count=lambda x: (n_patterns, 'patterns'))
+
+    cluster = Cluster(5, 0.8, 5, DATASETS.get(name).get('ws'), True)
+    timer.run('cluster', cluster.run, pattern_scoring, pset=dataset.pset,
+              count=lambda x: (cluster.stats.get('pairs', 0), 'pairs'))
+
+    results = timer.run('collect', collect_results, cluster, dataset.pset, True,
+                        count=lambda x: (len(x.get('match_sequences')), 'sites'))
+
+    clusters = [j for i, j in sorted(cluster.results.iteritems())]
+    merged = timer.run('collect.merge_patterns',
+                       lambda: [merge_patterns(i, True) for i in clusters],
+                       count=lambda x: (len(x), 'clusters'))
+    match_sequences = timer.run('collect.extract_match_info',
+                                lambda: [i.extract_match_info(dataset.pset) for i in merged],
+                                count=lambda x: (sum(len(i) for i in x), 'sites'))
+    timer.run('collect.pfm', lambda: [pfm([j[3] for j in i]) for i in match_sequences],
+              count=lambda x: (sum(len(i) for i in match_sequences), 'sites'))
+
+    timer.run('output', write_results, results, out,
+              count=lambda x: (sum(len(i) for i in results.itervalues()), 'rows'))
+
+    # Best similarity of each expected PFM with the PFM of any cluster
+    gc = gc_content(dataset.pset)
+    ans_pfms = {}
+    for fpath in files.get('ans'):
+        ans = read_pfm(fpath)
+        ans_pfms.update({os.path.basename(fpath): max(
+            [simpfm_array(ans, j, gc, None, True)[2] for i, j in results.get('pfms')] or [0])})
+
+    return {'stages': timer.stages, 'ans_pfms': ans_pfms}
+
+
+def _child(conn, func, args):
+    try:
+        conn.send((True, func(*args)))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+def run_isolated(func, *args):
+    """Run func in a fresh process and return its result
+
+    A run that fails or is killed (e.g. by running out of memory)
+    raises an Exception instead of hanging the benchmark."""
+    reader, writer = Pipe(False)
+    process = Process(target=_child, args=(writer, func, args))
+    process.start()
+    writer.close()
+    try:
+        succeeded, result = reader.recv()
+    except EOFError:
+        succeeded, result = False, None
+    process.join()
+
+    if not succeeded:
+        if result is None:
+            result = 'exited with code {0}'.format(process.exitcode)
+        raise Exception('[run_isolated] {0} failed: {1}'.format(func.__name__, result))
+
+    return result
+
+
+def run_dataset(name, scale, options, workdir):
+    """Run a dataset at a scale through the pipeline and stage by stage,
+    each in a fresh process, and return the report"""
+    files = dataset_files(name, scale, workdir)
+    with open(files.get('plist'), 'r') as fi:
+        n_patterns = sum(1 for i in fi if i.strip())
+
+    report = {
+        'scale': scale,
+        'n_pset': sum(1 for i in open(files.get('pset')) if i.startswith('>')),
+        'n_nset': sum(1 for i in open(files.get('nset')) if i.startswith('>')),
+        'n_patterns': n_patterns,
+    }
+    for key, func in [('pipeline', _pipeline_run), ('staged', _staged_run)]:
+        out = os.path.join(workdir, '{0}_x{1}.{2}.out'.format(name, scale, key))
+        result = run_isolated(func, name, files, options, out)
+        if key == 'pipeline':
+            report.update({'pipeline': result})
+        else:
+            report.update(result)
+
+    return report
+
+
+def host():
+    """Return the machine a baseline is saved on"""
+    return {'node': platform.node(), 'machine': platform.machine(),
+            'python': platform.python_version()}
+
+
+def check_baseline(baseline, options):
+    """Raise an Exception when the runs of the options cannot be
+    compared with the baseline"""
+    if baseline.get('version') != BASELINE_VERSION:
+        raise Exception('[check_baseline] Baseline version {0}, expected {1}; save it '
+                        'again'.format(baseline.get('version'), BASELINE_VERSION))
+    if baseline.get('options') != options:
+        raise Exception('[check_baseline] Baseline saved with options {0}, not {1}'.format(
+            json.dumps(baseline.get('options'), sort_keys=True),
+            json.dumps(options, sort_keys=True)))
+
+
+def compare(reports, baseline, tolerance, timings=True):
+    """Return the regressions of the reports against the baseline as a
+    list of messages
+
+    timings: also compare the wall times and peak RSS, which are only
+    comparable on the host the baseline was saved on"""
+    regressions = []
+    for key, report in sorted(reports.iteritems()):
+        base = baseline.get('runs', {}).get(key)
+        if base is None:
+            continue
+
+        stages = [('pipeline', report.get('pipeline'), base.get('pipeline'))]
+        base_stages = dict((i.get('name'), i) for i in base.get('stages', []))
+        for stage in report.get('stages'):
+            stages.append((stage.get('name'), stage, base_stages.get(stage.get('name'))))
+
+        for name, current, previous in stages:
+            if previous is None or not timings:
+                continue
+            if current.get('time') > previous.get('time') * (1 + tolerance) and \
+                    current.get('time') - previous.get('time') > MIN_TIME_DELTA:
+                regressions.append('{0} {1}: {2:.3f}s, baseline {3:.3f}s'.format(
+                    key, name, current.get('time'), previous.get('time')))
+            if current.get('peak_rss_mb') > previous.get('peak_rss_mb') * (1 + tolerance):
+                regressions.append('{0} {1}: peak RSS {2:.1f} MB, baseline {3:.1f} MB'.format(
+                    key, name, current.get('peak_rss_mb'), previous.get('peak_rss_mb')))
+
+        for fname, similarity in sorted(report.get('ans_pfms').iteritems()):
+            previous = base.get('ans_pfms', {}).get(fname)
+            if previous is not None and similarity < previous - MIN_SIMILARITY_DELTA:
+                regressions.append('{0} {1}: similarity {2:.3f}, baseline {3:.3f}'.format(
+                    key, fname, similarity, previous))
+
+    return regressions
+
+
+def write_report(key, report, fo):
+    fo.write('{0}: {1} pset, {2} nset sequences, {3} patterns\n'.format(
+        key, report.get('n_pset'), report.get('n_nset'), report.get('n_patterns')))
+    fo.write('  {0:<34}{1:>10}{2:>15}  {3}\n'.format('stage', 'time (s)', 'peak RSS (MB)',
+                                                   'throughput'))
+    pipeline = report.get('pipeline')
+    fo.write('  {0:<34}{1:>10.3f}{2:>15.1f}\n'.format('pipeline', pipeline.get('time'),
+                                                   pipeline.get('peak_rss_mb')))
+    for stage in report.get('stages'):
+        if stage.get('throughput') is None:
+            throughput = ''
+        else:
+            throughput = '{0:.1f} {1}'.format(stage.get('throughput'), stage.get('unit'))
+        fo.write('  {0:<34}{1:>10.3f}{2:>15.1f}  {3}\n'.format(
+            stage.get('name'), stage.get('time'), stage.get('peak_rss_mb'), throughput))
+    for fname, similarity in sorted(report.get('ans_pfms').iteritems()):
+        fo.write('  {0}: best similarity {1:.3f}\n'.format(fname, similarity))
+    fo.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark',
+                                     description='Time the rankMotif pipeline and its '
+                                     'stages on the bundled datasets.')
+    parser.add_argument('-datasets', nargs='+', choices=sorted(DATASETS),
+                        default=sorted(DATASETS), metavar='<name>',
+                        help='datasets to run (default: all)')
+    parser.add_argument('-scales', nargs='+', type=int, default=[1], metavar='<int>',
+                        help='scales of the datasets (default: 1)')
+    parser.add_argument('-baseline', metavar='<file>',
+                        help='JSON baseline to compare the results with')
+    parser.add_argument('-save', metavar='<file>',
+                        help='save the results as a JSON baseline')
+    parser.add_argument('-tolerance', type=float, default=0.25, metavar='<float>',
+                        help='relative slowdown or growth of peak RSS allowed against '
+                        'the baseline (default: 0.25)')
+    parser.add_argument('-engine', choices=['kmer', 'regex', 'bitparallel'], default='kmer',
+                        help='pattern matching engine (default: kmer)')
+    parser.add_argument('-cpu', type=int, default=1, metavar='<int>',
+                        help='Number of CPUs to build match tables (default: 1)')
+    parser.add_argument('-compact', choices=['yes', 'no'], default='no',
+                        help='keep match tables in compact arrays (default: no)')
+    parser.add_argument('-workdir', metavar='<dir>',
+                        help='directory of the scaled datasets and the outputs '
+                        '(default: a temporary directory, removed at the end)')
+    parser.add_argument('-log', metavar='<file>',
+                        help='log file of the runs (default: no logging)')
+    args = parser.parse_args()
+
+    if args.log:
+        logging.basicConfig(level=logging.INFO, filename=args.log,
+                            format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+                            datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.compact == 'yes':
+        compact = True
+    else:
+        compact = False
+    options = {'engine': args.engine, 'cpu': args.cpu, 'compact': compact}
+
+    # The baseline is checked before the runs, which can take hours
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as fi:
+            baseline = json.load(fi)
+        try:
+            check_baseline(baseline, options)
+        except Exception as e:
+            sys.exit(str(e))
+        timings = baseline.get('host') == host()
+        if not timings:
+            sys.stdout.write('{0} was saved on another host ({1}); comparing the PFM '
+                             'similarities only\n'.format(
+                                 args.baseline, json.dumps(baseline.get('host'), sort_keys=True)))
+
+    if args.workdir:
+        workdir = args.workdir
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix='rankmotif_benchmark_')
+
+    reports = {}
+    status = 0
+    try:
+        for scale in args.scales:
+            for name in args.datasets:
+                key = '{0}@{1}'.format(name, scale)
+                try:
+                    reports.update({key: run_dataset(name, scale, options, workdir)})
+                except Exception as e:
+                    sys.stdout.write('FAILED {0}: {1}\n'.format(key, e))
+                    status = 1
+                    continue
+                write_report(key, reports.get(key), sys.stdout)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    if baseline is not None:
+        regressions = compare(reports, baseline, args.tolerance, timings)
+        for i in regressions:
+            sys.stdout.write('REGRESSION {0}\n'.format(i))
+        if regressions:
+            status = 1
+        elif not status:
+            sys.stdout.write('no regressions against {0}\n'.format(args.baseline))
+
+    if args.save:
+        baseline = {'version': BASELINE_VERSION, 'host': host(), 'options': options,
+                    'runs': reports}
+        with open(args.save, 'w') as fo:
+            json.dump(baseline, fo, indent=2, sort_keys=True, separators=(',', ': '))
+            fo.write('\n')
+
+    return status
+
+
+if __name__ == '__main__':
+    if sys.hexversion > 0x03000000:
+        sys.exit('Unsupported python version: %s' % sys.version)
+    sys.exit(main())
@@ -13,10 +13,18 @@ import os
 import sys
 import logging
 import argparse
-from rankmotif.basic import Pattern, PatternSet, merge_patterns
-from rankmotif.scoring import PatternScoring
-from rankmotif.ranking import Cluster, pfm
-from rankmotif.seqio import parse_fasta
+from rankmotif.cache import MatchTableCache
+from rankmotif.pipeline import (Dataset, rank, score_patterns, sweep, collect_results,
+                                write_results, write_pattern_scores)
+from rankmotif.profiling import Profiler, enable, disable
+
+
+def weights(value):
+    try:
+        sp_weight, sn_weight, sc_weight = [int(i) for i in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('weights must be given as sp,sn,sc: {0}'.format(value))
+    return (sp_weight, sn_weight, sc_weight)
 
 
 def main():
@@ -34,12 +42,23 @@ def main():
                         help='sequence type of the patterns (dna or rna)')
     parser.add_argument('-out', required=True, metavar='<dir>',
                         help='output directory')
-    # parser.add_argument('-cpu', type=int, default=1,
-    #                     help='Number of CPUs to perform the analysis (default: 1)')
+    parser.add_argument('-cpu', type=int, default=1, metavar='<int>',
+                        help='Number of CPUs to perform the analysis (default: 1)')
+    parser.add_argument('-engine', choices=['kmer', 'regex', 'bitparallel'], default='kmer',
+                        help='pattern matching engine (default: kmer)')
+    parser.add_argument('-compact', choices=['yes', 'no'], default='no',
+                        help='keep match tables in compact arrays to save memory (default: no)')
+    parser.add_argument('-cache', metavar='<dir>',
+                        help='directory in which match tables are cached between runs')
+    parser.add_argument('-cache_size', type=int, default=1024, metavar='<int>',
+                        help='maximum size of the match table cache in MB (default: 1024)')
     parser.add_argument('-oc', metavar='<file>',
                         help='support of nucleosome occupancy scores')
     parser.add_argument('-cs', metavar='<file>',
                         help='support of conservation scores')
+    parser.add_argument('-score_cache', metavar='<dir>',
+                        help='directory in which the parsed -oc and -cs scores are cached '
+                        'between runs')
     parser.add_argument('-sp', type=int, default=1, metavar='<int>',
                         help='weight of position scoring (default: 1)')
     parser.add_argument('-sn', type=int, default=1, metavar='<int>',
@@ -47,6 +66,12 @@ def main():
                         'This option is valid only when -oc is specified. (default: 1)')
     parser.add_argument('-sc', type=int, default=1, metavar='<int>',
                         help='weight of conservation scoring (default: 1)')
+    parser.add_argument('-sweep', nargs='+', type=weights, metavar='<sp,sn,sc>',
+                        help='rank the patterns with each of the given weights instead of '
+                        '-sp, -sn and -sc, building the match tables and the component '
+                        'scores once. The results of each weights are written into '
+                        '<out>/sp<sp>_sn<sn>_sc<sc> and the component scores into '
+                        '<out>/pattern_scores.txt')
     parser.add_argument('-nc', type=int, default=5, metavar='<int>',
                         help='maximum number of clusters in the output (default: 5)')
     parser.add_argument('-np', type=int, default=5, metavar='<int>',
@@ -55,8 +80,25 @@ def main():
                         help='maximum window size of simpfm (default: auto)')
     parser.add_argument('-gc', type=float, metavar='<float>',
                         help='GC contents (default: auto)')
+    parser.add_argument('-prefilter', type=int, default=0, metavar='<int>',
+                        help='read the pattern list in chunks and only score and cluster '
+                        'the given number of patterns with the highest z-scores. '
+                        'A warning is logged when the patterns left out might change '
+                        'the clusters, i.e. when a bound of their scores is not below '
+                        'the score of the last pattern the clustering looked at '
+                        '(default: 0, keep all patterns)')
     parser.add_argument('-seqmask', choices=['yes', 'no'], default='no',
                         help='applying sequence mask (default: no)')
+    parser.add_argument('-compress', choices=['yes', 'no'], default='no',
+                        help='gzip the result files (default: no)')
+    parser.add_argument('-json', choices=['yes', 'no'], default='no',
+                        help='also write all result tables into <out>/results.json '
+                        '(default: no)')
+    parser.add_argument('-profile', choices=['yes', 'no', 'cprofile'], default='no',
+                        help='record the timings, call counts and memory of the pipeline '
+                        'stages and the hot functions in <out>/profile.json; cprofile '
+                        'also dumps cProfile statistics of each stage into <out>/profile '
+                        '(default: no)')
     parser.add_argument('-log', metavar='<file>',
                         help='log file (default: stdout)')
     parser.add_argument('-v', '--version', action='version',
@@ -90,95 +132,70 @@ def main():
     else:
         seqmask = False
 
-    pattern_set = PatternSet(reverse_complement)
-
-    logger.info('building match tables of patterns')
-    with open(args.plist, 'r') as fi:
-        for line in fi:
-            pattern = Pattern(line.strip())
-            pattern.build_matchtable_pset(parse_fasta(args.pset), reverse_complement)
-            pattern.build_matchtable_nset(parse_fasta(args.nset), reverse_complement)
-            pattern_set.add(pattern)
-
-    pattern_scoring = PatternScoring(sp_weight=args.sp, sn_weight=args.sn,
-                                     sc_weight=args.sc)
-    pattern_scoring.build(pattern_set, seqmask=seqmask, nuclocc=args.oc, consv=args.cs)
-
-    cluster = Cluster(args.nc, 0.8, args.np, args.ws, reverse_complement)
-    cluster.run(pattern_scoring, gc=args.gc, pset=args.pset)
-
-    cluster_pfm = {}
-    merseq_support = {}
-    pset_n_seqs = 0
-    logger.info('merging patterns and calculating PFMs')
-
-    with open(os.path.join(args.out, 'clustered_patterns.txt'), 'w') as fo_clu, \
-            open(os.path.join(args.out, 'merged_patterns.txt'), 'w') as fo_mer, \
-            open(os.path.join(args.out, 'match_sequences.txt'), 'w') as fo_mth:
-        fo_clu.write('\t'.join(['cluster_no', 'pattern', 'pset_support\n']))
-        fo_mer.write('\t'.join(['cluster_no', 'strand', 'pattern', 'pset_support\n']))
-        fo_mth.write('\t'.join(['cluster_no', 'gene_name', 'start', 'sequence', 'strand\n']))
-        # fo_mth.write('cluster: sequence\n')
-
-        merseq_support = {}
-        for i, j in cluster.results.iteritems():
-            for p in j:
-                pset_support = float(p.matchtable_pset.n_hitseqs) / p.matchtable_pset.n_seqs
-                pset_n_seqs = p.matchtable_pset.n_seqs
-
-                fo_clu.write('\t'.join([
-                    str(i),
-                    p.sequence.upper(),
-                    str(round(pset_support, 2)),
-                ]))
-
-                fo_clu.write('\n')
-                fo_clu.flush()
-
-            merged = merge_patterns(j, reverse_complement)
-            match_sequences = merged.extract_match_info(args.pset)
-
-            for p in merged.patterns:
-                strand = merged._strands.get(p)
-                if strand == 1:
-                    strand = '+'
-                else:
-                    strand = '-'
-                pset_support = float(p.matchtable_pset.n_hitseqs) / p.matchtable_pset.n_seqs
-
-                if i in merseq_support:
-                    merseq_support[i] |= set(p.matchtable_pset.match_sequences.keys())
-                else:
-                    merseq_support.update({i: set(p.matchtable_pset.match_sequences.keys())})
-
-                fo_mer.write('\t'.join([str(i), strand, p.sequence.upper(), str(round(pset_support, 2))]))
-                fo_mer.write('\n')
-                fo_mer.flush()
-
-            for gene_name, strand, start, seq in match_sequences:
-                if strand == 1:
-                    strand = '+'
-                else:
-                    strand = '-'
-                fo_mth.write('\t'.join([str(i), gene_name, str(start), seq.upper(), strand]))
-                fo_mth.write('\n')
-                fo_mth.flush()
-
-            cluster_pfm.update({i: pfm([x[3] for x in match_sequences])})
-
-    for i, j in cluster_pfm.iteritems():
-        with open(os.path.join(args.out, 'cluster_{0}.pfm.txt'.format(i)), 'w') as fo:
-            fo.write('cluster_{0}\t{1}\n'.format(i, str(len(j.get('a')))))
-            for base in ['a', 't', 'c', 'g']:
-                fo.write('\t'.join([str(i) for i in j.get(base)]))
-                fo.write('\n')
-                fo.flush()
-
-    with open(os.path.join(args.out, 'cluster_support.txt'), 'w') as fo:
-        fo.write('\t'.join(['cluster_no', 'pset_support\n']))
-        for i, j in merseq_support.iteritems():
-            fo.write('{0}\t{1}\n'.format(i, round(float(len(j)) / pset_n_seqs, 2)))
-            fo.flush()
+    if args.compact == 'yes':
+        compact = True
+    else:
+        compact = False
+
+    if args.compress == 'yes':
+        compress = True
+    else:
+        compress = False
+
+    if args.json == 'yes':
+        json_file = True
+    else:
+        json_file = False
+
+    if args.profile == 'cprofile':
+        profiler = Profiler(os.path.join(args.out, 'profile'))
+    elif args.profile == 'yes':
+        profiler = Profiler()
+    else:
+        profiler = None
+    if profiler is not None:
+        enable(profiler)
+
+    dataset = Dataset(args.pset, args.nset, oc=args.oc, cs=args.cs,
+                      score_cache=args.score_cache)
+
+    if args.cache:
+        cache = MatchTableCache(args.cache, args.cache_size * 1024 * 1024)
+    else:
+        cache = None
+
+    if args.sweep:
+        with open(args.plist, 'r') as fi:
+            pattern_scoring = score_patterns(dataset, (line.strip() for line in fi),
+                                             reverse_complement, seqmask=seqmask,
+                                             engine=args.engine, cpu=args.cpu, compact=compact,
+                                             cache=cache, prefilter=args.prefilter)
+        write_pattern_scores(pattern_scoring, os.path.join(args.out, 'pattern_scores.txt'))
+
+        for (sp, sn, sc), cluster in sweep(dataset, pattern_scoring, args.sweep,
+                                           reverse_complement, max_cluster=args.nc,
+                                           max_patterns_per_cluster=args.np,
+                                           simpfm_max_wsize=args.ws, gc=args.gc):
+            logger.info('writing the results of weights sp={0}, sn={1}, sc={2}'.format(
+                sp, sn, sc))
+            write_results(collect_results(cluster, dataset.pset, reverse_complement),
+                          os.path.join(args.out, 'sp{0}_sn{1}_sc{2}'.format(sp, sn, sc)),
+                          compress=compress, json_file=json_file)
+    else:
+        with open(args.plist, 'r') as fi:
+            cluster = rank(dataset, (line.strip() for line in fi), reverse_complement,
+                           sp_weight=args.sp, sn_weight=args.sn, sc_weight=args.sc,
+                           max_cluster=args.nc, max_patterns_per_cluster=args.np,
+                           simpfm_max_wsize=args.ws, gc=args.gc, seqmask=seqmask,
+                           engine=args.engine, cpu=args.cpu, compact=compact, cache=cache,
+                           prefilter=args.prefilter)
+
+        write_results(collect_results(cluster, dataset.pset, reverse_complement), args.out,
+                      compress=compress, json_file=json_file)
+
+    if profiler is not None:
+        disable()
+        profiler.save(os.path.join(args.out, 'profile.json'))
 
     logger.info('Job has finished.')
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# rankMotifBatch
+#
+# Run rankMotif on many datasets listed in a manifest, in one batch
+# process that shares the inputs common to several datasets.
+#
+# Author: Jian-Long Huang <jianlong@ntu.edu.tw>
+
+__version__ = '1.6'
+
+import sys
+import logging
+import argparse
+from rankmotif.cache import MatchTableCache
+from rankmotif.batch import read_manifest, BatchRunner
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='rankMotifBatch',
+                                     description='Run rankMotif on the datasets '
+                                     'of a manifest.')
+    parser.add_argument('-manifest', required=True, metavar='<file>',
+                        help='tab-separated manifest of the datasets, with a header line '
+                        'naming the columns name, pset, nset, plist and out, and '
+                        'optionally seqtype, oc, cs, log, sp, sn, sc, nc, np, ws, gc, '
+                        'seqmask and prefilter')
+    parser.add_argument('-cpu', type=int, default=1, metavar='<int>',
+                        help='Number of datasets run at the same time (default: 1)')
+    parser.add_argument('-engine', choices=['kmer', 'regex', 'bitparallel'], default='kmer',
+                        help='pattern matching engine (default: kmer)')
+    parser.add_argument('-compact', choices=['yes', 'no'], default='no',
+                        help='keep match tables in compact arrays to save memory (default: no)')
+    parser.add_argument('-cache', metavar='<dir>',
+                        help='directory in which match tables are cached between runs')
+    parser.add_argument('-cache_size', type=int, default=1024, metavar='<int>',
+                        help='maximum size of the match table cache in MB (default: 1024)')
+    parser.add_argument('-score_cache', metavar='<dir>',
+                        help='directory in which the parsed -oc and -cs scores are cached '
+                        'between runs')
+    parser.add_argument('-compress', choices=['yes', 'no'], default='no',
+                        help='gzip the result files (default: no)')
+    parser.add_argument('-json', choices=['yes', 'no'], default='no',
+                        help='also write all result tables into <out>/results.json '
+                        '(default: no)')
+    parser.add_argument('-log', metavar='<file>',
+                        help='log file of the batch (default: stdout)')
+    parser.add_argument('-v', '--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+    args = parser.parse_args()
+
+    log_config = {
+        'level': logging.INFO,
+        'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+        'datefmt': '%Y-%m-%d %H:%M:%S',
+    }
+    if args.log:
+        log_config.update({'filename': args.log})
+    else:
+        log_config.update({'stream': sys.stdout})
+
+    logging.basicConfig(**log_config)
+
+    logger = logging.getLogger('main')
+
+    if args.compact == 'yes':
+        compact = True
+    else:
+        compact = False
+
+    if args.compress == 'yes':
+        compress = True
+    else:
+        compress = False
+
+    if args.json == 'yes':
+        json_file = True
+    else:
+        json_file = False
+
+    if args.cache:
+        cache = MatchTableCache(args.cache, args.cache_size * 1024 * 1024)
+    else:
+        cache = None
+
+    jobs = read_manifest(args.manifest)
+    logger.info('running {0} datasets'.format(len(jobs)))
+
+    runner = BatchRunner(jobs, args.cpu, engine=args.engine, compact=compact, cache=cache,
+                         score_cache=args.score_cache, compress=compress, json_file=json_file)
+    results = runner.run()
+
+    n_failed = len([i for i in results.itervalues() if not i[0]])
+    logger.info('Batch has finished: {0} succeeded, {1} failed.'.format(
+        len(results) - n_failed, n_failed))
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if sys.hexversion > 0x03000000:
+        sys.exit('Unsupported python version: %s' % sys.version)
+    main()
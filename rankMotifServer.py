@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# rankMotifServer
+#
+# Keep the sequence sets and the base scores of a dataset in memory
+# and rank the pattern lists submitted over HTTP.
+#
+# Author: Jian-Long Huang <jianlong@ntu.edu.tw>
+
+__version__ = '1.6'
+
+import sys
+import logging
+import argparse
+from rankmotif.cache import MatchTableCache
+from rankmotif.pipeline import Dataset
+from rankmotif.server import RankingServer
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='rankMotifServer',
+                                     description='Keep a dataset loaded and rank '
+                                     'the pattern lists posted as JSON to '
+                                     'http://<host>:<port>/rank.')
+    parser.add_argument('-pset', required=True, metavar='<file>',
+                        help='positive set of Chip-Chip sequences in FASTA format')
+    parser.add_argument('-nset', required=True, metavar='<file>',
+                        help='negative set of Chip-Chip sequences in FASTA format')
+    parser.add_argument('-oc', metavar='<file>',
+                        help='support of nucleosome occupancy scores')
+    parser.add_argument('-cs', metavar='<file>',
+                        help='support of conservation scores')
+    parser.add_argument('-score_cache', metavar='<dir>',
+                        help='directory in which the parsed -oc and -cs scores are cached '
+                        'between runs')
+    parser.add_argument('-host', default='127.0.0.1', metavar='<host>',
+                        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-port', type=int, default=8000, metavar='<int>',
+                        help='port to listen on (default: 8000)')
+    parser.add_argument('-out', metavar='<dir>',
+                        help='directory into which jobs may write result files, each into '
+                        'the subdirectory given as its out (default: no result files)')
+    parser.add_argument('-cpu', type=int, default=1, metavar='<int>',
+                        help='Number of worker processes running the jobs (default: 1)')
+    parser.add_argument('-engine', choices=['kmer', 'regex', 'bitparallel'], default='kmer',
+                        help='pattern matching engine (default: kmer)')
+    parser.add_argument('-compact', choices=['yes', 'no'], default='no',
+                        help='keep match tables in compact arrays to save memory (default: no)')
+    parser.add_argument('-cache', metavar='<dir>',
+                        help='directory in which match tables are cached between runs')
+    parser.add_argument('-cache_size', type=int, default=1024, metavar='<int>',
+                        help='maximum size of the match table cache in MB (default: 1024)')
+    parser.add_argument('-log', metavar='<file>',
+                        help='log file (default: stdout)')
+    parser.add_argument('-v', '--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+    args = parser.parse_args()
+
+    log_config = {
+        'level': logging.INFO,
+        'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+        'datefmt': '%Y-%m-%d %H:%M:%S',
+    }
+    if args.log:
+        log_config.update({'filename': args.log})
+    else:
+        log_config.update({'stream': sys.stdout})
+
+    logging.basicConfig(**log_config)
+
+    logger = logging.getLogger('main')
+
+    if args.compact == 'yes':
+        compact = True
+    else:
+        compact = False
+
+    if args.cache:
+        cache = MatchTableCache(args.cache, args.cache_size * 1024 * 1024)
+    else:
+        cache = None
+
+    dataset = Dataset(args.pset, args.nset, oc=args.oc, cs=args.cs,
+                      score_cache=args.score_cache)
+
+    server = RankingServer(dataset, (args.host, args.port), args.cpu, out=args.out,
+                           engine=args.engine, compact=compact, cache=cache)
+    logger.info('listening on http://{0}:{1}/rank'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    logger.info('Server has stopped.')
+
+
+if __name__ == '__main__':
+    if sys.hexversion > 0x03000000:
+        sys.exit('Unsupported python version: %s' % sys.version)
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# rankMotifShard
+#
+# Run rankMotif on a pattern list split into shards: each map job
+# builds the match tables and the partial scores of one slice of the
+# pattern list and writes them into a shard file; the reduce job merges
+# the shard files of all slices, clusters the patterns and writes the
+# results of a single rankMotif run.
+#
+#     rankMotifShard.py map -shard 1/8 -out shards/1.npz [...]
+#     ...
+#     rankMotifShard.py map -shard 8/8 -out shards/8.npz [...]
+#     rankMotifShard.py reduce -shards shards/*.npz -out results [...]
+#
+# Author: Jian-Long Huang <jianlong@ntu.edu.tw>
+
+__version__ = '1.6'
+
+import os
+import sys
+import logging
+import argparse
+from itertools import islice
+from rankmotif.cache import MatchTableCache
+from rankmotif.pipeline import Dataset, cluster_patterns, collect_results, write_results
+from rankmotif.sharding import ShardState, shard_range, map_shard, reduce_shards
+
+
+def shard(value):
+    try:
+        k, n = [int(i) for i in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be given as k/n: {0}'.format(value))
+    if not 0 < k <= n:
+        raise argparse.ArgumentTypeError('shard must be in 1/n to n/n: {0}'.format(value))
+    return (k, n)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='rankMotifShard',
+                                     description='Run rankMotif on a pattern list '
+                                     'split into shards.')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    map_parser = subparsers.add_parser('map', help='build the partial scores of one shard '
+                                       'of the pattern list')
+    map_parser.add_argument('-pset', required=True, metavar='<file>',
+                            help='positive set of Chip-Chip sequences in FASTA format')
+    map_parser.add_argument('-nset', required=True, metavar='<file>',
+                            help='negative set of Chip-Chip sequences in FASTA format')
+    map_parser.add_argument('-plist', required=True, metavar='<file>',
+                            help='pattern list file')
+    map_parser.add_argument('-seqtype', required=True, metavar='(dna|rna)',
+                            choices=['dna', 'rna'],
+                            help='sequence type of the patterns (dna or rna)')
+    map_parser.add_argument('-shard', required=True, type=shard, metavar='<k/n>',
+                            help='map the k-th of n contiguous slices of the pattern list')
+    map_parser.add_argument('-out', required=True, metavar='<file>',
+                            help='shard file')
+    map_parser.add_argument('-cpu', type=int, default=1, metavar='<int>',
+                            help='Number of CPUs to perform the analysis (default: 1)')
+    map_parser.add_argument('-engine', choices=['kmer', 'regex', 'bitparallel'], default='kmer',
+                            help='pattern matching engine (default: kmer)')
+    map_parser.add_argument('-compact', choices=['yes', 'no'], default='no',
+                            help='keep match tables in compact arrays to save memory '
+                            '(default: no)')
+    map_parser.add_argument('-cache', metavar='<dir>',
+                            help='directory in which match tables are cached between runs')
+    map_parser.add_argument('-cache_size', type=int, default=1024, metavar='<int>',
+                            help='maximum size of the match table cache in MB (default: 1024)')
+    map_parser.add_argument('-oc', metavar='<file>',
+                            help='support of nucleosome occupancy scores')
+    map_parser.add_argument('-cs', metavar='<file>',
+                            help='support of conservation scores')
+    map_parser.add_argument('-score_cache', metavar='<dir>',
+                            help='directory in which the parsed -oc and -cs scores are cached '
+                            'between runs')
+    map_parser.add_argument('-log', metavar='<file>',
+                            help='log file (default: stdout)')
+
+    reduce_parser = subparsers.add_parser('reduce', help='merge the shard files and write '
+                                          'the results')
+    reduce_parser.add_argument('-pset', required=True, metavar='<file>',
+                               help='positive set of Chip-Chip sequences in FASTA format')
+    reduce_parser.add_argument('-nset', required=True, metavar='<file>',
+                               help='negative set of Chip-Chip sequences in FASTA format')
+    reduce_parser.add_argument('-shards', required=True, nargs='+', metavar='<file>',
+                               help='shard files of all slices of the pattern list')
+    reduce_parser.add_argument('-out', required=True, metavar='<dir>',
+                               help='output directory')
+    reduce_parser.add_argument('-compact', choices=['yes', 'no'], default='no',
+                               help='keep match tables in compact arrays to save memory '
+                               '(default: no)')
+    reduce_parser.add_argument('-sp', type=int, default=1, metavar='<int>',
+                               help='weight of position scoring (default: 1)')
+    reduce_parser.add_argument('-sn', type=int, default=1, metavar='<int>',
+                               help='weight of nucleosome occupancy scoring. This option is '
+                               'valid only when the shards were mapped with -oc. (default: 1)')
+    reduce_parser.add_argument('-sc', type=int, default=1, metavar='<int>',
+                               help='weight of conservation scoring (default: 1)')
+    reduce_parser.add_argument('-nc', type=int, default=5, metavar='<int>',
+                               help='maximum number of clusters in the output (default: 5)')
+    reduce_parser.add_argument('-np', type=int, default=5, metavar='<int>',
+                               help='maximum number of patterns per cluster (default: 5)')
+    reduce_parser.add_argument('-ws', type=int, metavar='<int>',
+                               help='maximum window size of simpfm (default: auto)')
+    reduce_parser.add_argument('-gc', type=float, metavar='<float>',
+                               help='GC contents (default: auto)')
+    reduce_parser.add_argument('-seqmask', choices=['yes', 'no'], default='no',
+                               help='applying sequence mask (default: no)')
+    reduce_parser.add_argument('-compress', choices=['yes', 'no'], default='no',
+                               help='gzip the result files (default: no)')
+    reduce_parser.add_argument('-json', choices=['yes', 'no'], default='no',
+                               help='also write all result tables into <out>/results.json '
+                               '(default: no)')
+    reduce_parser.add_argument('-log', metavar='<file>',
+                               help='log file (default: stdout)')
+
+    parser.add_argument('-v', '--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+    args = parser.parse_args()
+
+    log_config = {
+        'level': logging.INFO,
+        'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+        'datefmt': '%Y-%m-%d %H:%M:%S',
+    }
+    if args.log:
+        log_config.update({'filename': args.log})
+    else:
+        log_config.update({'stream': sys.stdout})
+
+    logging.basicConfig(**log_config)
+
+    logger = logging.getLogger('main')
+
+    if args.compact == 'yes':
+        compact = True
+    else:
+        compact = False
+
+    if args.mode == 'map':
+        if args.seqtype == 'dna':
+            reverse_complement = True
+        else:
+            reverse_complement = False
+
+        if args.cache:
+            cache = MatchTableCache(args.cache, args.cache_size * 1024 * 1024)
+        else:
+            cache = None
+
+        dataset = Dataset(args.pset, args.nset, oc=args.oc, cs=args.cs,
+                          score_cache=args.score_cache)
+
+        k, n = args.shard
+        with open(args.plist, 'r') as fi:
+            start, stop = shard_range(sum(1 for line in fi), k, n)
+            fi.seek(0)
+            state = map_shard(dataset, (line.strip() for line in islice(fi, start, stop)), k, n,
+                              reverse_complement, engine=args.engine, cpu=args.cpu,
+                              compact=compact, cache=cache)
+
+        out_dir = os.path.dirname(args.out)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        state.save(args.out)
+        logger.info('wrote shard {0}/{1} (patterns {2}-{3}) into {4}'.format(
+            k, n, start + 1, stop, args.out))
+    else:
+        if args.seqmask == 'yes':
+            seqmask = True
+        else:
+            seqmask = False
+
+        if args.compress == 'yes':
+            compress = True
+        else:
+            compress = False
+
+        if args.json == 'yes':
+            json_file = True
+        else:
+            json_file = False
+
+        dataset = Dataset(args.pset, args.nset)
+        states = [ShardState.load(fpath) for fpath in args.shards]
+        reverse_complement = states[0].meta.get('reverse_complement')
+
+        pattern_scoring = reduce_shards(dataset, states, sp_weight=args.sp, sn_weight=args.sn,
+                                        sc_weight=args.sc, seqmask=seqmask, compact=compact)
+        cluster = cluster_patterns(dataset, pattern_scoring, reverse_complement,
+                                   max_cluster=args.nc, max_patterns_per_cluster=args.np,
+                                   simpfm_max_wsize=args.ws, gc=args.gc)
+
+        write_results(collect_results(cluster, dataset.pset, reverse_complement), args.out,
+                      compress=compress, json_file=json_file)
+
+    logger.info('Job has finished.')
+
+
+if __name__ == '__main__':
+    if sys.hexversion > 0x03000000:
+        sys.exit('Unsupported python version: %s' % sys.version)
+    main()
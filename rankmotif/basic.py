@@ -1,6 +1,9 @@
 import re
 import logging
-from seqio import revcomp, parse_fasta
+import numpy as np
+from array import array
+from seqio import revcomp, SequenceSet
+from profiling import profiled
 
 
 class Pattern(object):
@@ -15,23 +18,31 @@ class Pattern(object):
     def __len__(self):
         return len(self.sequence)
 
-    def build_matchtable_pset(self, seqset, reverse_complement=False, append=False):
+    def build_matchtable_pset(self, seqset, reverse_complement=False, append=False, compact=False):
         if not self.matchtable_pset or not append:
-            self.matchtable_pset = MatchTable(reverse_complement)
+            self.matchtable_pset = MatchTable(reverse_complement, compact)
         self.matchtable_pset.index(self.sequence, seqset, append)
 
         return self
 
-    def build_matchtable_nset(self, seqset, reverse_complement=False, append=False):
+    def build_matchtable_nset(self, seqset, reverse_complement=False, append=False, compact=False,
+                              count_only=False):
         if not self.matchtable_nset or not append:
-            self.matchtable_nset = MatchTable(reverse_complement)
+            self.matchtable_nset = MatchTable(reverse_complement, compact, count_only)
         self.matchtable_nset.index(self.sequence, seqset, append)
 
         return self
 
 
 class MatchTable(object):
-    """Index of a pattern sequence against the matching sequences"""
+    """Index of a pattern sequence against the matching sequences
+
+    compact: keep only the (seqid, start, strand) of each site in arrays
+    and derive the positions and matched sequences on access from the
+    SequenceSet that was indexed (see _CompactMatchPosition).
+    count_only: only count the sequences (n_seqs) and the sequences
+    with a match (n_hitseqs); each sequence is scanned up to its first
+    site, and no sites are stored or counted (n_hitsites)."""
 
     class _MatchPosition(object):
 
@@ -68,19 +79,133 @@ class MatchTable(object):
                 mseq = (1, hit[hit_start: hit_end])
                 self.match_sequences.get(seqid).append(mseq)
 
-    def __init__(self, reverse_complement=False):
+    class _CompactMatchPosition(object):
+        """Sites kept as (seqid, start, strand) arrays
+
+        The sites of a seqid are stored contiguously, in the order they
+        are added. The dicts of _MatchPosition are exposed as read-only
+        views computed from the wildcard mask of the pattern and the
+        SequenceSet of the sites."""
+
+        def __init__(self, seqset):
+            self.seqset = seqset
+            self.length = None
+            self.wildcards = {}
+            self.nonwildcards = {}
+            self.seqids = array('l')
+            self.starts = array('l')
+            self.strands = array('b')
+            self._ranges = {}
+
+        def add(self, gene_name, seqid, query, hit, hit_start, hit_end, is_rc_match):
+            if self.length is None:
+                self.length = len(query)
+                forward = revcomp(query) if is_rc_match else query
+                for strand, i in ((1, forward), (2, revcomp(forward))):
+                    self.wildcards.update({strand: [x for x, y in enumerate(i) if y == 'n']})
+                    self.nonwildcards.update({strand: [x for x, y in enumerate(i) if y != 'n']})
+
+            site = len(self.starts)
+            if seqid not in self._ranges:
+                self._ranges.update({seqid: [site, site + 1]})
+            elif self._ranges.get(seqid)[1] == site:
+                self._ranges.get(seqid)[1] += 1
+            else:
+                raise Exception('[MatchTable] Sites of seqid {0} are not contiguous'.format(seqid))
+            self.seqids.append(seqid)
+            self.starts.append(hit_start)
+            self.strands.append(2 if is_rc_match else 1)
+
+        def _pos_matches(self, site):
+            start = self.starts[site]
+            return range(start, start + self.length)
+
+        def _pos_wildcards(self, site):
+            start = self.starts[site]
+            return [start + i for i in self.wildcards.get(self.strands[site])]
+
+        def _pos_nonwildcards(self, site):
+            start = self.starts[site]
+            return [start + i for i in self.nonwildcards.get(self.strands[site])]
+
+        def _match_sequences(self, site):
+            start = self.seqset.offsets[self.seqids[site] - 1] + self.starts[site]
+            return (self.strands[site], self.seqset.data[start: start + self.length])
+
+        @property
+        def seqid(self):
+            return set(self._ranges)
+
+        @property
+        def gene_name(self):
+            return _SiteView(self._ranges, lambda seqid: self.seqset.gene_name(seqid))
+
+        @property
+        def pos_matches(self):
+            return _SiteView(self._ranges, self._pos_matches, per_site=True)
+
+        @property
+        def pos_wildcards(self):
+            return _SiteView(self._ranges, self._pos_wildcards, per_site=True)
+
+        @property
+        def pos_nonwildcards(self):
+            return _SiteView(self._ranges, self._pos_nonwildcards, per_site=True)
+
+        @property
+        def match_sequences(self):
+            return _SiteView(self._ranges, self._match_sequences, per_site=True)
+
+    def __init__(self, reverse_complement=False, compact=False, count_only=False):
         self.reverse_complement = reverse_complement
-        self._match_position = self._MatchPosition()
+        self.compact = compact
+        self.count_only = count_only
+        self.reset()
+
+    def __getstate__(self):
+        # The match position classes are nested and cannot be pickled by
+        # reference; the SequenceSet of a compact table is left out and
+        # has to be given back with attach() after unpickling
+        state = self.__dict__.copy()
+        match_position = self._match_position.__dict__.copy()
+        match_position.pop('seqset', None)
+        state.update({'_match_position': match_position})
+        return state
+
+    def __setstate__(self, state):
+        if state.get('compact'):
+            match_position = self._CompactMatchPosition(None)
+        else:
+            match_position = self._MatchPosition()
+        match_position.__dict__.update(state.pop('_match_position'))
+        self.__dict__.update(state)
+        self._match_position = match_position
+
+    def attach(self, seqset):
+        """Attach the SequenceSet the sites of a compact table refer to"""
+        if self.compact:
+            self._match_position.seqset = seqset
+
+    def reset(self, seqset=None):
+        """Drop all sites; compact tables refer to the SequenceSet
+        that is indexed next"""
+        if self.compact:
+            if seqset is not None and not isinstance(seqset, SequenceSet):
+                raise Exception('[MatchTable] Compact match tables need a SequenceSet')
+            self._match_position = self._CompactMatchPosition(seqset)
+        else:
+            self._match_position = self._MatchPosition()
         self.n_hitseqs = 0
         self.n_hitsites = 0
         self.n_seqs = 0
+        # PFMs of the matched sequences, filled by pfm.pfm()
+        self.pfm_cache = {}
 
+    @profiled('MatchTable.index')
     def index(self, sequence, seqset, append=False):
         if not append:
-            self._match_position = self._MatchPosition()
-            self.n_hitseqs = 0
-            self.n_hitsites = 0
-            self.n_seqs = 0
+            self.reset(seqset)
+        self.pfm_cache = {}
 
         rc_sequence = revcomp(sequence)
         p = re.compile('(?=({0})|({1}))'.format(
@@ -92,23 +217,140 @@ class MatchTable(object):
             seqid += 1
             i = i.lower()
             self.n_seqs += 1
+            if self.count_only:
+                if p.search(i):
+                    self.n_hitseqs += 1
+                continue
             has_match = False
             for j in p.finditer(i):
                 has_match = True
-                self.n_hitsites += 1
-                if self.reverse_complement:
-                    if j.group(1):
-                        self._match_position.add(
-                            gene_name, seqid, sequence, i, j.start(), j.start() + len(j.group(1)), False)
-                    elif j.group(2):
-                        self._match_position.add(
-                            gene_name, seqid, rc_sequence, i, j.start(), j.start() + len(j.group(2)), True)
-                elif j.group(1):
-                    self._match_position.add(
-                        gene_name, seqid, sequence, i, j.start(), j.start() + len(j.group(1)), False)
+                if j.group(1):
+                    self.add_site(gene_name, seqid, sequence, i, j.start(), False)
+                elif j.group(2):
+                    self.add_site(gene_name, seqid, rc_sequence, i, j.start(), True)
             if has_match:
                 self.n_hitseqs += 1
 
+    def index_candidates(self, sequence, seqset, candidates):
+        """Index sequence against a SequenceSet at the candidate
+        (seqid, start) pairs only
+
+        The table is the one of index() as long as every site is a
+        candidate."""
+        assert isinstance(seqset, SequenceSet)
+        self.reset(seqset)
+
+        rc_sequence = revcomp(sequence)
+        p_fw = re.compile(sequence.replace('n', '[atcg]'))
+        p_rc = re.compile(rc_sequence.replace('n', '[atcg]'))
+
+        self.n_seqs += len(seqset)
+
+        data = seqset.data
+        offsets = seqset.offsets
+        last_seqid = None
+        for seqid, start in sorted(set(candidates)):
+            offset = offsets[seqid - 1]
+            if start < 0 or offset + start + len(sequence) > offsets[seqid]:
+                continue
+            if p_fw.match(data, offset + start):
+                query = sequence
+                is_rc_match = False
+            elif p_rc.match(data, offset + start):
+                query = rc_sequence
+                is_rc_match = True
+            else:
+                continue
+
+            if seqid != last_seqid:
+                last_seqid = seqid
+                hit = seqset.sequence(seqid)
+                self.n_hitseqs += 1
+            if not self.count_only:
+                self.add_site(seqset.gene_name(seqid), seqid, query, hit, start, is_rc_match)
+
+    def add_site(self, gene_name, seqid, query, hit, hit_start, is_rc_match):
+        """Record a site of hit (the sequence of seqid) matched by query
+
+        Reverse-complement sites are counted but only stored
+        when reverse_complement is set."""
+        if self.count_only:
+            raise Exception('[MatchTable] Sites cannot be added to a count-only table')
+        self.n_hitsites += 1
+        if is_rc_match and not self.reverse_complement:
+            return
+        self._match_position.add(
+            gene_name, seqid, query, hit, hit_start, hit_start + len(query), is_rc_match)
+
+    def sites(self):
+        """Return the seqids, start positions and strands of the stored
+        sites as three int64 NumPy arrays, in seqid order"""
+        if self.compact:
+            mp = self._match_position
+            return (np.array(mp.seqids, dtype=np.int64), np.array(mp.starts, dtype=np.int64),
+                    np.array(mp.strands, dtype=np.int64))
+
+        seqids = []
+        starts = []
+        strands = []
+        for seqid, indices in sorted(self.pos_matches.iteritems()):
+            for index, (strand, match_sequence) in zip(indices, self.match_sequences.get(seqid)):
+                seqids.append(seqid)
+                starts.append(index[0])
+                strands.append(strand)
+
+        return (np.array(seqids, dtype=np.int64), np.array(starts, dtype=np.int64),
+                np.array(strands, dtype=np.int64))
+
+    def add_sites(self, sequence, seqset, seqids, starts, strands):
+        """Add the sites returned by sites() of a table of the pattern
+        sequence against a SequenceSet
+
+        The positions and matched sequences of the sites are rebuilt
+        from seqset. Every site is counted in n_hitsites; n_seqs and
+        n_hitseqs are left to the caller."""
+        assert isinstance(seqset, SequenceSet)
+        rc_sequence = revcomp(sequence)
+        for seqid, start, strand in zip(seqids.tolist(), starts.tolist(), strands.tolist()):
+            if strand == 2:
+                query = rc_sequence
+            else:
+                query = sequence
+            self.add_site(seqset.gene_name(seqid), seqid, query, seqset.sequence(seqid), start,
+                          strand == 2)
+
+    def site_positions(self, nonwildcards=False):
+        """Return the seqids and the positions covered by the sites as
+        two NumPy arrays, in seqid order
+
+        nonwildcards: only the positions of the non-wildcard bases"""
+        if self.compact:
+            mp = self._match_position
+            if not len(mp.starts):
+                return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            if nonwildcards:
+                offsets = np.array([mp.nonwildcards.get(1), mp.nonwildcards.get(2)], dtype=np.int64)
+            else:
+                offsets = np.tile(np.arange(mp.length, dtype=np.int64), (2, 1))
+            strands = np.array(mp.strands, dtype=np.int64)
+            starts = np.array(mp.starts, dtype=np.int64)
+            positions = (starts[:, np.newaxis] + offsets[strands - 1]).ravel()
+            seqids = np.repeat(np.array(mp.seqids, dtype=np.int64), offsets.shape[1])
+            return (seqids, positions)
+
+        if nonwildcards:
+            pos = self.pos_nonwildcards
+        else:
+            pos = self.pos_matches
+        seqids = []
+        positions = []
+        for seqid, indices in sorted(pos.iteritems()):
+            for index in indices:
+                seqids.extend([seqid] * len(index))
+                positions.extend(index)
+
+        return (np.array(seqids, dtype=np.int64), np.array(positions, dtype=np.int64))
+
     @property
     def seqid(self):
         return self._match_position.seqid
@@ -134,6 +376,61 @@ class MatchTable(object):
         return self._match_position.match_sequences
 
 
+class _SiteView(object):
+    """Read-only dict-like view of seqid -> value
+
+    ranges maps each seqid to the [first, last + 1) interval of its
+    sites; with per_site the value of a seqid is the list of func(site)
+    over its sites, otherwise it is func(seqid)."""
+
+    def __init__(self, ranges, func, per_site=False):
+        self._ranges = ranges
+        self._func = func
+        self._per_site = per_site
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __iter__(self):
+        return iter(sorted(self._ranges))
+
+    def __contains__(self, seqid):
+        return seqid in self._ranges
+
+    def __getitem__(self, seqid):
+        if seqid not in self._ranges:
+            raise KeyError(seqid)
+        if self._per_site:
+            return [self._func(i) for i in xrange(*self._ranges.get(seqid))]
+        else:
+            return self._func(seqid)
+
+    def get(self, seqid, default=None):
+        if seqid not in self._ranges:
+            return default
+        return self[seqid]
+
+    def keys(self):
+        return list(self)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for seqid in self:
+            yield self[seqid]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for seqid in self:
+            yield (seqid, self[seqid])
+
+    def items(self):
+        return list(self.iteritems())
+
+
 class PatternSet(object):
     """A set of pattern objects without redundant pattern sequences"""
 
@@ -168,21 +465,30 @@ class MergePattern(object):
         self.reverse_complement = reverse_complement
         self.patterns = []
         self._strands = {}
+        self._seeds = {}
 
-    def add(self, pattern, strand):
+    def add(self, pattern, strand, seed=None):
+        """seed: Pattern whose sequence (strand 1) or reverse complement
+        (strand 2), padded with wildcards, is the sequence of pattern"""
         self.patterns.append(pattern)
         self._strands.update({pattern: strand})
+        self._seeds.update({pattern: seed})
+
+    @profiled('MergePattern.extract_match_info')
+    def extract_match_info(self, seqset):
+        """seqset: SequenceSet of the positive set or path to its FASTA file"""
+        if not isinstance(seqset, SequenceSet):
+            seqset = SequenceSet(seqset)
 
-    def extract_match_info(self, fasta_handle):
         matches = set()
         match_info = []
 
-        for pattern in self._strands:
-            pattern.build_matchtable_pset(
-                parse_fasta(fasta_handle), self.reverse_complement)
+        for pattern in self.patterns:
+            if not self._index_from_seed(pattern, seqset):
+                pattern.build_matchtable_pset(seqset, self.reverse_complement)
 
-        for pattern in self._strands:
-            for seqid, pos in pattern.matchtable_pset.pos_matches.iteritems():
+        for pattern in self.patterns:
+            for seqid, pos in sorted(pattern.matchtable_pset.pos_matches.iteritems()):
                 for i, j in enumerate(pos):
                     gene_name = pattern.matchtable_pset.gene_name.get(seqid)
                     match_strand, match_sequence = pattern.matchtable_pset.match_sequences.get(seqid)[i]
@@ -201,6 +507,49 @@ class MergePattern(object):
 
         return match_info
 
+    def _index_from_seed(self, pattern, seqset):
+        """Build the match table of a padded pattern from the sites of
+        its seed and return whether it could
+
+        Each site of the padded pattern contains a site of the seed
+        (either strand) shifted by the padding on one side or the other,
+        so only these candidates are verified. Reverse-complement sites
+        of the seed are only stored with reverse_complement."""
+        seed = self._seeds.get(pattern)
+        if not self.reverse_complement or seed is None or seed.matchtable_pset is None or \
+                seed.matchtable_pset.n_seqs != len(seqset):
+            return False
+
+        if self._strands.get(pattern) == 2:
+            left = _padding(pattern.sequence, revcomp(seed.sequence))
+        else:
+            left = _padding(pattern.sequence, seed.sequence)
+        if left is None:
+            return False
+        right = len(pattern) - len(seed) - left
+
+        candidates = []
+        for seqid, indices in seed.matchtable_pset.pos_matches.iteritems():
+            for index in indices:
+                candidates.append((seqid, index[0] - left))
+                candidates.append((seqid, index[0] - right))
+
+        pattern.matchtable_pset = MatchTable(self.reverse_complement)
+        pattern.matchtable_pset.index_candidates(pattern.sequence, seqset, candidates)
+
+        return True
+
+
+def _padding(padded, sequence):
+    """Return the number of wildcards on the left of sequence in padded,
+    or None if padded is not sequence padded with wildcards"""
+    for i in xrange(len(padded) - len(sequence) + 1):
+        if padded[i: i + len(sequence)] == sequence and \
+                not padded[:i].strip('n') and not padded[i + len(sequence):].strip('n'):
+            return i
+
+    return None
+
 
 def merge_patterns(pattern_list, reverse_complement=False):
     """Merge patterns and return directional pattern objects
@@ -210,91 +559,63 @@ def merge_patterns(pattern_list, reverse_complement=False):
         reference = pattern_list[0].sequence
         for pattern in pattern_list[1:]:
             reference = merge_sequences(reference, pattern.sequence, reverse_complement)[0]
-        merged_patterns.add(Pattern(reference), 1)
+        merged_patterns.add(Pattern(reference), 1, pattern_list[0])
         for pattern in pattern_list[1:]:
             seq_1, seq_2, strands = merge_sequences(reference, pattern.sequence, reverse_complement)
-            merged_patterns.add(Pattern(seq_2), strands[1])
+            merged_patterns.add(Pattern(seq_2), strands[1], pattern)
     else:
-        merged_patterns.add(Pattern(pattern_list[0].sequence), 1)
+        merged_patterns.add(Pattern(pattern_list[0].sequence), 1, pattern_list[0])
 
     return merged_patterns
 
 
+@profiled('merge_sequences')
 def merge_sequences(seq_1, seq_2, reverse_complement=False):
-    arrlen = len(seq_1) + len(seq_2) - 1
-    max_score = -1
-    best_seq1 = None
-    best_seq2 = None
-    best_strands = None
-
-    strands_1 = [1, 1]
-    for i in xrange(arrlen - len(seq_1) + 1):
-        for j in xrange(arrlen - len(seq_2) + 1):
-            if j > i:
-                left_1 = ''
-                left_2 = 'n' * (j - i)
-            elif i > j:
-                left_1 = 'n' * (i - j)
-                left_2 = ''
-            else:
-                left_1 = ''
-                left_2 = ''
-
-            if len(seq_2) + j - 1 > len(seq_1) + i - 1:
-                right_1 = 'n' * ((len(seq_2) + j - 1) - (len(seq_1) + i - 1))
-                right_2 = ''
-            elif len(seq_1) + i - 1 > len(seq_2) + j - 1:
-                right_1 = ''
-                right_2 = 'n' * ((len(seq_1) + i - 1) - (len(seq_2) + j - 1))
-            else:
-                right_1 = ''
-                right_2 = ''
-
-            s1 = '%s%s%s' % (left_1, seq_1, right_1)
-            s2 = '%s%s%s' % (left_2, seq_2, right_2)
-            score = full_alignment_scoring(s1, s2)
-            if score > max_score:
-                max_score = score
-                best_seq1 = s1
-                best_seq2 = s2
-                best_strands = strands_1
+    """Align seq_2 (and its reverse complement) to seq_1 and return the
+    two sequences padded with wildcards to the best alignment, and the
+    strands of seq_1 and seq_2
+
+    The alignments are scored as in full_alignment_scoring. Each
+    relative shift is scored once; ties go to the first best shift in
+    the order (i, j) offsets were once tried in (seq_2 shifted right by
+    0, 1, ..., then left by 1, 2, ...) and to the forward strand."""
+    shifts, scores = _shift_scores(seq_1, seq_2)
+    best = np.argmax(scores)
+    best_shift = int(shifts[best])
+    best_strands = [1, 1]
 
     if reverse_complement:
-        strands_2 = [1, 2]
-        seq_2 = revcomp(seq_2)
-
-        for i in xrange(arrlen - len(seq_1) + 1):
-            for j in xrange(arrlen - len(seq_2) + 1):
-                if j > i:
-                    left_1 = ''
-                    left_2 = 'n' * (j - i)
-                elif i > j:
-                    left_1 = 'n' * (i - j)
-                    left_2 = ''
-                else:
-                    left_1 = ''
-                    left_2 = ''
-
-                if len(seq_2) + j - 1 > len(seq_1) + i - 1:
-                    right_1 = 'n' * ((len(seq_2) + j - 1) - (len(seq_1) + i - 1))
-                    right_2 = ''
-                elif len(seq_1) + i - 1 > len(seq_2) + j - 1:
-                    right_1 = ''
-                    right_2 = 'n' * ((len(seq_1) + i - 1) - (len(seq_2) + j - 1))
-                else:
-                    right_1 = ''
-                    right_2 = ''
-
-                s1 = '%s%s%s' % (left_1, seq_1, right_1)
-                s2 = '%s%s%s' % (left_2, seq_2, right_2)
-                score = full_alignment_scoring(s1, s2)
-                if score > max_score:
-                    max_score = score
-                    best_seq1 = s1
-                    best_seq2 = s2
-                    best_strands = strands_2
-
-    return (best_seq1, best_seq2, best_strands)
+        rc_seq_2 = revcomp(seq_2)
+        shifts, scores_rc = _shift_scores(seq_1, rc_seq_2)
+        best_rc = np.argmax(scores_rc)
+        if scores_rc[best_rc] > scores[best]:
+            seq_2 = rc_seq_2
+            best_shift = int(shifts[best_rc])
+            best_strands = [1, 2]
+
+    # seq_2 starts best_shift bases after seq_1
+    left_1 = 'n' * max(-best_shift, 0)
+    left_2 = 'n' * max(best_shift, 0)
+    right_1 = 'n' * max(len(seq_2) + best_shift - len(seq_1), 0)
+    right_2 = 'n' * max(len(seq_1) - len(seq_2) - best_shift, 0)
+
+    return ('%s%s%s' % (left_1, seq_1, right_1), '%s%s%s' % (left_2, seq_2, right_2), best_strands)
+
+
+def _shift_scores(seq_1, seq_2):
+    """Return the shifts of seq_2 relative to seq_1, in the order of
+    merge_sequences, and the number of matching non-wildcard bases at
+    each shift"""
+    codes_1 = np.frombuffer(seq_1, dtype=np.uint8)
+    codes_2 = np.frombuffer(seq_2, dtype=np.uint8)
+    matches = (codes_1[:, np.newaxis] == codes_2) & (codes_1[:, np.newaxis] != ord('n'))
+    # Position k of seq_1 faces position m of seq_2 at shift k - m
+    diagonals = np.subtract.outer(np.arange(len(seq_1)), np.arange(len(seq_2))) + len(seq_2) - 1
+    scores = np.bincount(diagonals.ravel(), weights=matches.ravel(),
+                         minlength=len(seq_1) + len(seq_2) - 1)
+
+    shifts = np.concatenate([np.arange(len(seq_1)), -np.arange(1, len(seq_2))])
+    return (shifts, scores[shifts + len(seq_2) - 1])
 
 
 def full_alignment_scoring(seq_1, seq_2):
@@ -0,0 +1,250 @@
+import os
+import time
+import logging
+import traceback
+from multiprocessing import Pipe, Process
+from .pipeline import Dataset, rank, collect_results, write_results
+from .scoring import parse_base_score
+from .seqio import SequenceSet
+
+# Columns of a manifest, and how their values are converted
+REQUIRED_COLUMNS = ['name', 'pset', 'nset', 'plist', 'out']
+OPTIONAL_COLUMNS = {
+    'seqtype': str,
+    'oc': str,
+    'cs': str,
+    'log': str,
+    'sp': int,
+    'sn': int,
+    'sc': int,
+    'nc': int,
+    'np': int,
+    'ws': int,
+    'gc': float,
+    'seqmask': str,
+    'prefilter': int,
+}
+
+# Sequence sets and base scores loaded before the jobs are forked
+_inputs = {}
+
+
+def read_manifest(fpath):
+    """Read the jobs of a batch from a manifest and return them as a list
+    of dicts
+
+    A manifest is a tab-separated file whose first line names the
+    columns. name, pset, nset, plist and out are required; seqtype (dna
+    or rna, default dna), oc, cs, log (default <out>/rankMotif.log) and
+    the ranking options sp, sn, sc, nc, np, ws, gc, seqmask (yes or no)
+    and prefilter of rankMotif.py are optional. An empty value or '-'
+    leaves a column unset:
+
+        name      pset            nset            plist     out      oc
+        ABF1_YPD  ABF1.pos.fasta  YPD.neg.fasta   ABF1_YPD  out/ABF1 ABF1.histone.txt
+        DIG1_YPD  DIG1.pos.fasta  YPD.neg.fasta   DIG1_YPD  out/DIG1 -"""
+    jobs = []
+    with open(fpath, 'r') as fi:
+        lines = [i.rstrip('\r\n') for i in fi if i.strip() and not i.startswith('#')]
+    if not lines:
+        raise Exception('[read_manifest] Empty manifest: {0}'.format(fpath))
+
+    columns = lines[0].split('\t')
+    for column in columns:
+        if column not in REQUIRED_COLUMNS and column not in OPTIONAL_COLUMNS:
+            raise Exception('[read_manifest] Unknown column: {0}'.format(column))
+    for column in REQUIRED_COLUMNS:
+        if column not in columns:
+            raise Exception('[read_manifest] Missing column: {0}'.format(column))
+
+    names = set()
+    for lineno, line in enumerate(lines[1:], 2):
+        values = line.split('\t')
+        if len(values) != len(columns):
+            raise Exception('[read_manifest] Line {0}: {1} values, {2} columns'.format(
+                lineno, len(values), len(columns)))
+
+        job = {}
+        for column, value in zip(columns, values):
+            value = value.strip()
+            if value in ['', '-']:
+                continue
+            try:
+                job.update({column: OPTIONAL_COLUMNS.get(column, str)(value)})
+            except ValueError:
+                raise Exception('[read_manifest] Line {0}: invalid {1}: {2}'.format(
+                    lineno, column, value))
+
+        for column in REQUIRED_COLUMNS:
+            if column not in job:
+                raise Exception('[read_manifest] Line {0}: {1} is required'.format(
+                    lineno, column))
+        if job.get('name') in names:
+            raise Exception('[read_manifest] Line {0}: duplicate name: {1}'.format(
+                lineno, job.get('name')))
+        if job.setdefault('seqtype', 'dna') not in ['dna', 'rna']:
+            raise Exception('[read_manifest] Line {0}: seqtype must be dna or rna'.format(lineno))
+        if job.setdefault('seqmask', 'no') not in ['yes', 'no']:
+            raise Exception('[read_manifest] Line {0}: seqmask must be yes or no'.format(lineno))
+        job.setdefault('log', os.path.join(job.get('out'), 'rankMotif.log'))
+
+        names.add(job.get('name'))
+        jobs.append(job)
+
+    return jobs
+
+
+def job_cost(job):
+    """Rough cost of a job: the pattern list size times the size of the
+    sequence sets; 0 when a file is missing, and the job fails when it
+    runs"""
+    try:
+        return os.path.getsize(job.get('plist')) * (
+            os.path.getsize(job.get('pset')) + os.path.getsize(job.get('nset')))
+    except OSError:
+        return 0
+
+
+class BatchRunner(object):
+    """Run the jobs of a manifest (see read_manifest) in forked worker
+    processes, up to workers at a time
+
+    The jobs are started from the largest (see job_cost) to the
+    smallest. The sequence sets and base score files used by more than
+    one job are loaded once, before the workers are forked, and shared
+    with them; a file is dropped from the batch process once the last
+    job using it has started.
+
+    Every job logs into its own file and runs in its own process: a
+    job that fails, or whose process dies, is reported and the others
+    go on.
+    options: engine, compact, cache, score_cache, compress and json_file
+    of the jobs (see rank and write_results)"""
+
+    def __init__(self, jobs, workers=1, **options):
+        assert workers > 0
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.jobs = jobs
+        self.workers = workers
+        self.options = options
+        self.results = {}
+
+    def run(self):
+        """Run the jobs and return a dict of their results by name:
+        (succeeded, elapsed seconds, error message)"""
+        self.results = {}
+        pending = sorted(self.jobs, key=lambda x: (-job_cost(x), x.get('name')))
+
+        # Number of the pending jobs using each input
+        users = {}
+        for job in pending:
+            for key in self._input_keys(job):
+                users.update({key: users.get(key, 0) + 1})
+        for key, n in sorted(users.iteritems()):
+            if n > 1:
+                self._logger.info('loading {0} shared by {1} jobs'.format(key[1], n))
+                _inputs.update({key: _load(*key, score_cache=self.options.get('score_cache'))})
+
+        running = []
+        while pending or running:
+            while pending and len(running) < self.workers:
+                job = pending.pop(0)
+                reader, writer = Pipe(False)
+                process = Process(target=_run_job, args=(writer, job, self.options))
+                process.start()
+                writer.close()
+                running.append((job, process, reader, time.time()))
+                self._logger.info('started {0}'.format(job.get('name')))
+
+                for key in self._input_keys(job):
+                    users.update({key: users.get(key) - 1})
+                    if not users.get(key):
+                        _inputs.pop(key, None)
+
+            for item in list(running):
+                job, process, reader, start = item
+                if not reader.poll() and process.is_alive():
+                    continue
+
+                # A job may exit right after sending its result
+                try:
+                    error = reader.recv()
+                except EOFError:
+                    process.join()
+                    error = 'exited with code {0}'.format(process.exitcode)
+                process.join()
+                reader.close()
+                running.remove(item)
+                elapsed = time.time() - start
+                self.results.update({job.get('name'): (error is None, elapsed, error)})
+                if error is None:
+                    self._logger.info('finished {0} in {1:.1f}s'.format(job.get('name'), elapsed))
+                else:
+                    self._logger.error('{0} failed: {1} (see {2})'.format(
+                        job.get('name'), error.strip().splitlines()[-1], job.get('log')))
+
+            if running:
+                time.sleep(0.05)
+
+        return self.results
+
+    def _input_keys(self, job):
+        keys = set([('seqset', job.get('pset')), ('seqset', job.get('nset'))])
+        for column in ['oc', 'cs']:
+            if job.get(column):
+                keys.add(('scores', job.get(column)))
+        return sorted(keys)
+
+
+def _load(kind, fpath, score_cache=None):
+    if (kind, fpath) in _inputs:
+        return _inputs.get((kind, fpath))
+    if kind == 'seqset':
+        return SequenceSet(fpath)
+    return parse_base_score(fpath, cache=score_cache)
+
+
+def _run_job(conn, job, options):
+    """Run a job and send None or the error through conn"""
+    if not os.path.exists(job.get('out')):
+        os.makedirs(job.get('out'))
+
+    # The job logs into its own file only
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.FileHandler(job.get('log'), 'w')
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+                                           '%Y-%m-%d %H:%M:%S'))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    logger = logging.getLogger('main')
+
+    try:
+        score_cache = options.get('score_cache')
+        dataset = Dataset(_load('seqset', job.get('pset')), _load('seqset', job.get('nset')),
+                          oc=job.get('oc') and _load('scores', job.get('oc'), score_cache),
+                          cs=job.get('cs') and _load('scores', job.get('cs'), score_cache))
+
+        reverse_complement = job.get('seqtype') == 'dna'
+        with open(job.get('plist'), 'r') as fi:
+            cluster = rank(dataset, (line.strip() for line in fi), reverse_complement,
+                           sp_weight=job.get('sp', 1), sn_weight=job.get('sn', 1),
+                           sc_weight=job.get('sc', 1), max_cluster=job.get('nc', 5),
+                           max_patterns_per_cluster=job.get('np', 5),
+                           simpfm_max_wsize=job.get('ws'), gc=job.get('gc'),
+                           seqmask=job.get('seqmask') == 'yes', prefilter=job.get('prefilter'),
+                           engine=options.get('engine', 'kmer'),
+                           compact=options.get('compact', False), cache=options.get('cache'))
+
+        write_results(collect_results(cluster, dataset.pset, reverse_complement), job.get('out'),
+                      compress=options.get('compress', False),
+                      json_file=options.get('json_file', False))
+        logger.info('Job has finished.')
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        logger.error(error)
+
+    conn.send(error)
+    conn.close()
@@ -0,0 +1,131 @@
+import os
+import errno
+import hashlib
+import logging
+import numpy as np
+from .basic import MatchTable
+from .seqio import SequenceSet
+
+# Bumped whenever the layout of the cache entries changes
+CACHE_VERSION = 1
+
+
+class MatchTableCache(object):
+    """Match tables stored in a directory and shared between runs
+
+    An entry holds the match table of one pattern sequence against one
+    sequence set. It is keyed by the pattern sequence, the fingerprint
+    of the SequenceSet (a hash of its content), the reverse-complement
+    flag and whether the table is count-only, and stored as a single
+    int64 array:
+
+        [n_seqs, n_hitseqs, n_hitsites, n_sites, seqids..., starts...,
+         strands...]
+
+    The positions and matched sequences of the sites are rebuilt from
+    the SequenceSet on loading, into a compact or a regular table.
+
+    Entries are written to a temporary file and renamed into place, so
+    several jobs can share a directory; a reader never sees a partial
+    entry, and an entry removed by another job is just a miss. The
+    modification time of an entry is its last use: when the entries
+    take more than max_size bytes, the least recently used ones are
+    removed."""
+
+    def __init__(self, path, max_size=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, sequence, seqset, reverse_complement, count_only=False):
+        assert isinstance(seqset, SequenceSet)
+        digest = hashlib.sha1()
+        digest.update('{0}\t{1}\t{2}\t{3}'.format(
+            CACHE_VERSION, sequence, seqset.fingerprint(), int(reverse_complement)))
+        if count_only:
+            digest.update('\tcount_only')
+        return digest.hexdigest()
+
+    def _fpath(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, sequence, seqset, reverse_complement=False, compact=False, count_only=False):
+        """Return the cached match table of a pattern sequence, or None"""
+        fpath = self._fpath(self.key(sequence, seqset, reverse_complement, count_only))
+        try:
+            values = np.load(fpath)
+            # Mark the entry as recently used
+            os.utime(fpath, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        n_seqs, n_hitseqs, n_hitsites, n_sites = [int(i) for i in values[:4]]
+        seqids = values[4: 4 + n_sites]
+        starts = values[4 + n_sites: 4 + 2 * n_sites]
+        strands = values[4 + 2 * n_sites: 4 + 3 * n_sites]
+
+        matchtable = MatchTable(reverse_complement, compact, count_only)
+        matchtable.reset(seqset)
+        matchtable.add_sites(sequence, seqset, seqids, starts, strands)
+        matchtable.n_seqs = n_seqs
+        matchtable.n_hitseqs = n_hitseqs
+        matchtable.n_hitsites = n_hitsites
+
+        self.hits += 1
+        return matchtable
+
+    def put(self, sequence, seqset, matchtable):
+        """Store the match table of a pattern sequence against seqset"""
+        seqids, starts, strands = matchtable.sites()
+
+        values = np.concatenate([
+            [matchtable.n_seqs, matchtable.n_hitseqs, matchtable.n_hitsites, len(seqids)],
+            seqids, starts, strands]).astype(np.int64)
+
+        fpath = self._fpath(self.key(
+            sequence, seqset, matchtable.reverse_complement, matchtable.count_only))
+        tmp_fpath = '{0}.{1}.tmp'.format(fpath, os.getpid())
+        with open(tmp_fpath, 'wb') as fo:
+            np.save(fo, values)
+        os.rename(tmp_fpath, fpath)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        in max_size bytes"""
+        if self.max_size is None:
+            return
+
+        entries = []
+        for fname in os.listdir(self.path):
+            if not fname.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, fname))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+
+        size = sum(i[1] for i in entries)
+        n_removed = 0
+        for mtime, fsize, fname in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, fname))
+                n_removed += 1
+            except OSError:
+                # Removed by another job in the meantime
+                pass
+            size -= fsize
+
+        if n_removed:
+            self._logger.info('evicted {0} match tables from the cache'.format(n_removed))
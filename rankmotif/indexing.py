@@ -0,0 +1,459 @@
+import re
+import numpy as np
+from array import array
+from bisect import bisect_right
+from multiprocessing import Pool
+from .basic import Pattern, MatchTable
+from .profiling import profiled, count
+from .seqio import revcomp, SequenceSet
+
+MAX_ANCHOR_SIZE = 8
+
+
+def anchors(sequence):
+    """Split the non-wildcard bases of a pattern sequence into anchors
+
+    Return a list of (offset, k-mer) pairs covering every run of
+    non-wildcard bases; runs longer than MAX_ANCHOR_SIZE are split."""
+    results = []
+    for m in re.finditer('[^n]+', sequence):
+        for i in xrange(m.start(), m.end(), MAX_ANCHOR_SIZE):
+            results.append((i, sequence[i: min(i + MAX_ANCHOR_SIZE, m.end())]))
+
+    return results
+
+
+class KmerIndex(object):
+    """Positions of a selection of k-mers in a sequence set
+
+    The sequence set is encoded once into base-4 codes (a, c, g, t), and
+    the codes of all windows of each k-mer size are computed with NumPy;
+    the positions of the selected k-mers are then grouped by sorting the
+    matching windows by code. K-mers with other bases are found with
+    str.find. Positions are offsets into SequenceSet.data, kept as
+    sorted int64 arrays, and never span two sequences."""
+
+    def __init__(self, seqset, kmers):
+        assert isinstance(seqset, SequenceSet)
+
+        kmers = set(kmer for kmer in kmers if kmer)
+        self._positions = {}
+        if not kmers or not seqset.data:
+            return
+
+        data = np.frombuffer(seqset.data, dtype=np.uint8)
+        codes = _BASE_CODES[data]
+        # Number of bases other than a, c, g and t before each position
+        n_invalid = np.concatenate([[0], np.cumsum(codes == 4)])
+        offsets = np.array(seqset.offsets, dtype=np.int64)
+        # End of the sequence of each position
+        ends = np.repeat(offsets[1:], np.diff(offsets))
+
+        for k in set(len(kmer) for kmer in kmers):
+            selected = [kmer for kmer in kmers if len(kmer) == k and not kmer.strip('acgt')]
+            if not selected or k > len(data):
+                continue
+            n_windows = len(data) - k + 1
+            window_codes = np.zeros(n_windows, dtype=np.int64)
+            for j in xrange(k):
+                window_codes = window_codes * 4 + (codes[j: j + n_windows] & 3)
+            valid = (n_invalid[k: k + n_windows] == n_invalid[:n_windows]) & \
+                (np.arange(n_windows) + k <= ends[:n_windows])
+
+            kmer_codes = np.array([_kmer_code(kmer) for kmer in selected], dtype=np.int64)
+            starts = np.flatnonzero(valid & np.in1d(window_codes, kmer_codes))
+            # Stable, so the positions of each k-mer stay sorted
+            starts = starts[np.argsort(window_codes[starts], kind='mergesort')]
+            starts_codes = window_codes[starts]
+            lefts = np.searchsorted(starts_codes, kmer_codes, 'left')
+            rights = np.searchsorted(starts_codes, kmer_codes, 'right')
+            for kmer, left, right in zip(selected, lefts, rights):
+                self._positions.update({kmer: starts[left: right]})
+
+        for kmer in kmers:
+            if kmer.strip('acgt'):
+                self._positions.update({kmer: np.array(self._find(seqset, kmer),
+                                                       dtype=np.int64)})
+
+    @staticmethod
+    def _find(seqset, kmer):
+        """Return the positions of a k-mer within one sequence"""
+        data = seqset.data
+        offsets = seqset.offsets
+        positions = []
+        i = data.find(kmer)
+        while i >= 0:
+            if i + len(kmer) <= offsets[bisect_right(offsets, i)]:
+                positions.append(i)
+            i = data.find(kmer, i + 1)
+        return positions
+
+    def get(self, kmer):
+        positions = self._positions.get(kmer)
+        if positions is None:
+            return np.zeros(0, dtype=np.int64)
+        return positions
+
+
+# Base-4 code of each byte; 4 for the bytes other than a, c, g and t
+_BASE_CODES = np.zeros(256, dtype=np.int64) + 4
+for _code, _base in enumerate('acgt'):
+    _BASE_CODES[ord(_base)] = _code
+
+
+def _kmer_code(kmer):
+    code = 0
+    for base in kmer:
+        code = code * 4 + 'acgt'.index(base)
+    return code
+
+
+class MultiPatternIndexer(object):
+    """Build the match tables of many patterns against a sequence set
+
+    The non-wildcard bases of each pattern (and of its reverse
+    complement) are split into anchors, and the positions of all anchors
+    are collected by a shared KmerIndex, so the sequences are scanned
+    once instead of once per pattern. A site is a candidate only if
+    every anchor of the pattern occurs at its offset; candidates are
+    then verified against the whole pattern. The resulting match tables
+    are identical to the ones of MatchTable.index.
+
+    count_only: build count-only match tables; the candidates of a
+    sequence are no longer verified once one of them matches."""
+
+    def __init__(self, seqset, reverse_complement=False, compact=False, count_only=False):
+        assert isinstance(seqset, SequenceSet)
+        self.seqset = seqset
+        self.reverse_complement = reverse_complement
+        self.compact = compact
+        self.count_only = count_only
+
+    @profiled('MultiPatternIndexer.index')
+    def index(self, sequences):
+        """Return the match tables of the pattern sequences, in order"""
+        sequences = list(sequences)
+        queries = []
+        for sequence in sequences:
+            queries.append((anchors(sequence), anchors(revcomp(sequence))))
+
+        kmers = set()
+        for fw_anchors, rc_anchors in queries:
+            kmers.update(kmer for offset, kmer in fw_anchors)
+            kmers.update(kmer for offset, kmer in rc_anchors)
+        kmer_index = KmerIndex(self.seqset, kmers)
+
+        matchtables = []
+        for sequence, (fw_anchors, rc_anchors) in zip(sequences, queries):
+            matchtable = MatchTable(self.reverse_complement, self.compact, self.count_only)
+            if fw_anchors:
+                matchtable.reset(self.seqset)
+                self._index(matchtable, sequence, kmer_index, fw_anchors, rc_anchors)
+            else:
+                # Nothing to anchor on
+                matchtable.index(sequence, self.seqset)
+            matchtables.append(matchtable)
+
+        return matchtables
+
+    def _candidates(self, kmer_index, query_anchors):
+        """Return the start positions at which every anchor occurs"""
+        query_anchors = sorted(
+            [(kmer_index.get(kmer), offset) for offset, kmer in query_anchors],
+            key=lambda x: len(x[0]))
+        positions, offset = query_anchors[0]
+        starts = positions - offset
+        for positions, offset in query_anchors[1:]:
+            if not len(positions):
+                return []
+            shifted = starts + offset
+            found = positions[np.minimum(np.searchsorted(positions, shifted), len(positions) - 1)]
+            starts = starts[found == shifted]
+
+        return starts.tolist()
+
+    def _index(self, matchtable, sequence, kmer_index, fw_anchors, rc_anchors):
+        data = self.seqset.data
+        offsets = self.seqset.offsets
+        rc_sequence = revcomp(sequence)
+        p_fw = re.compile(sequence.replace('n', '[atcg]'))
+        p_rc = re.compile(rc_sequence.replace('n', '[atcg]'))
+
+        # Candidate sites as (seqid, start) pairs
+        candidates = set()
+        for i in self._candidates(kmer_index, fw_anchors) + self._candidates(kmer_index, rc_anchors):
+            seqid = bisect_right(offsets, i)
+            if i >= 0 and i + len(sequence) <= offsets[seqid]:
+                candidates.add((seqid, i))
+
+        matchtable.n_seqs += len(self.seqset)
+
+        last_seqid = None
+        for seqid, start in sorted(candidates):
+            if self.count_only and seqid == last_seqid:
+                continue
+            if p_fw.match(data, start):
+                query = sequence
+                is_rc_match = False
+            elif p_rc.match(data, start):
+                query = rc_sequence
+                is_rc_match = True
+            else:
+                continue
+
+            if seqid != last_seqid:
+                last_seqid = seqid
+                hit = self.seqset.sequence(seqid)
+                matchtable.n_hitseqs += 1
+            if self.count_only:
+                continue
+            matchtable.add_site(
+                self.seqset.gene_name(seqid), seqid, query, hit,
+                start - offsets[seqid - 1], is_rc_match)
+
+
+# Bit-reversed value of each byte; np.packbits stores the first bit in
+# the most significant bit of a byte
+_REVERSED_BITS = np.array([int('{0:08b}'.format(i)[::-1], 2) for i in xrange(256)],
+                          dtype=np.uint8)
+
+
+class BitParallelIndexer(object):
+    """Build the match tables of many patterns against a sequence set
+    with bit-parallel matching
+
+    The sequence set is encoded once into one bitmask per base (a, c, g
+    and t) and one of all four bases, the mask a wildcard matches. Each
+    mask is packed into uint64 words: bit j of word k is position
+    64 * k + j of SequenceSet.data. The starts of the sites of a pattern
+    are the AND of the masks of its bases, each shifted by the offset of
+    the base, and of the starts whose window lies within one sequence.
+    The reverse complement is tested in the same pass over the offsets.
+    The resulting match tables are identical to the ones of
+    MatchTable.index.
+
+    count_only: build count-only match tables"""
+
+    def __init__(self, seqset, reverse_complement=False, compact=False, count_only=False):
+        assert isinstance(seqset, SequenceSet)
+        self.seqset = seqset
+        self.reverse_complement = reverse_complement
+        self.compact = compact
+        self.count_only = count_only
+
+        self._offsets = np.array(seqset.offsets, dtype=np.int64)
+        codes = np.frombuffer(seqset.data, dtype=np.uint8)
+        self._n_words = len(codes) // 64 + 1
+        self._masks = {}
+        for base in 'acgt':
+            self._masks.update({base: _pack(codes == ord(base), self._n_words)})
+        self._masks.update({'n': self._masks.get('a') | self._masks.get('c') |
+                            self._masks.get('g') | self._masks.get('t')})
+        # Starts of the windows within one sequence, per window size
+        self._windows = {}
+
+    @profiled('BitParallelIndexer.index')
+    def index(self, sequences):
+        """Return the match tables of the pattern sequences, in order"""
+        matchtables = []
+        for sequence in sequences:
+            matchtable = MatchTable(self.reverse_complement, self.compact, self.count_only)
+            if sequence and not sequence.strip('acgtn'):
+                matchtable.reset(self.seqset)
+                self._index(matchtable, sequence)
+            else:
+                # Nothing to match bases against
+                matchtable.index(sequence, self.seqset)
+            matchtables.append(matchtable)
+
+        return matchtables
+
+    def _index(self, matchtable, sequence):
+        rc_sequence = revcomp(sequence)
+        window = self._window(len(sequence))
+        fw_starts = window & self._shifted(sequence[0], 0)
+        rc_starts = window & self._shifted(rc_sequence[0], 0)
+        for i in xrange(1, len(sequence)):
+            fw_starts &= self._shifted(sequence[i], i)
+            rc_starts &= self._shifted(rc_sequence[i], i)
+
+        starts = _unpack(fw_starts | rc_starts)
+        offsets = self._offsets
+        seqids = np.searchsorted(offsets, starts, side='right')
+
+        matchtable.n_seqs += len(self.seqset)
+        matchtable.n_hitseqs += len(np.unique(seqids))
+        if self.count_only:
+            return
+
+        # A start matched by both strands is a forward site, as in the
+        # alternation of MatchTable.index
+        is_rc_matches = ((fw_starts[starts >> 6] >> (starts & 63).astype(np.uint64)) & 1) == 0
+        last_seqid = None
+        for seqid, start, is_rc_match in zip(seqids.tolist(), starts.tolist(),
+                                             is_rc_matches.tolist()):
+            if seqid != last_seqid:
+                last_seqid = seqid
+                gene_name = self.seqset.gene_name(seqid)
+                hit = self.seqset.sequence(seqid)
+                offset = offsets[seqid - 1]
+            if is_rc_match:
+                matchtable.add_site(gene_name, seqid, rc_sequence, hit, start - offset, True)
+            else:
+                matchtable.add_site(gene_name, seqid, sequence, hit, start - offset, False)
+
+    def _shifted(self, base, offset):
+        """Return the mask of a base shifted by offset: bit x is bit
+        x + offset of the mask"""
+        words = self._masks.get(base)
+        q, r = divmod(offset, 64)
+        if len(words) < q + self._n_words + 1:
+            # Zero words beyond the end of the data
+            words = np.concatenate([words, np.zeros(q + 1, dtype=np.uint64)])
+            self._masks.update({base: words})
+        if not r:
+            return words[q: q + self._n_words]
+
+        return (words[q: q + self._n_words] >> np.uint64(r)) | \
+            (words[q + 1: q + self._n_words + 1] << np.uint64(64 - r))
+
+    def _window(self, size):
+        """Return the mask of the starts of the windows of size bases
+        that lie within one sequence"""
+        if size not in self._windows:
+            offsets = self._offsets
+            first = offsets[:-1]
+            last = np.maximum(offsets[1:] - size + 1, first)
+            delta = np.zeros(offsets[-1] + 1, dtype=np.int32)
+            np.add.at(delta, first, 1)
+            np.add.at(delta, last, -1)
+            self._windows.update({size: _pack(np.cumsum(delta[:-1]) > 0, self._n_words)})
+
+        return self._windows.get(size)
+
+
+def _pack(bits, n_words):
+    """Pack a boolean array into n_words uint64 words, bit j of word k
+    holding bits[64 * k + j]"""
+    packed = np.zeros(n_words * 8, dtype=np.uint8)
+    packed[:(len(bits) + 7) // 8] = _REVERSED_BITS[np.packbits(bits)]
+    return packed.view('<u8').astype(np.uint64)
+
+
+def _unpack(words):
+    """Return the positions of the set bits of words packed by _pack, in
+    order"""
+    index = np.flatnonzero(words)
+    bits = np.unpackbits(_REVERSED_BITS[words[index].astype('<u8').view(np.uint8)])
+    rows, columns = np.nonzero(bits.reshape(-1, 64))
+    return index[rows] * 64 + columns
+
+
+def index_patterns(sequences, pset, nset, reverse_complement=False, engine='kmer',
+                   compact=False):
+    """Return the (pset, nset) match tables of the pattern sequences,
+    in order
+
+    engine: 'kmer' indexes all patterns with a single scan of each
+    sequence set (MultiPatternIndexer), 'regex' scans the sequence sets
+    once per pattern (MatchTable.index), 'bitparallel' matches each
+    pattern against bitmasks of the sequence sets (BitParallelIndexer).
+    compact: build array-backed match tables.
+    Only the hit counts of the nset are used in scoring, so its match
+    tables are count-only (see MatchTable)."""
+    if engine == 'regex':
+        matchtables = []
+        for sequence in sequences:
+            pattern = Pattern(sequence)
+            pattern.build_matchtable_pset(pset, reverse_complement, compact=compact)
+            pattern.build_matchtable_nset(nset, reverse_complement, compact=compact,
+                                          count_only=True)
+            matchtables.append((pattern.matchtable_pset, pattern.matchtable_nset))
+    elif engine == 'kmer':
+        matchtables = zip(
+            MultiPatternIndexer(pset, reverse_complement, compact).index(sequences),
+            MultiPatternIndexer(nset, reverse_complement, compact, True).index(sequences))
+    elif engine == 'bitparallel':
+        matchtables = zip(
+            BitParallelIndexer(pset, reverse_complement, compact).index(sequences),
+            BitParallelIndexer(nset, reverse_complement, compact, True).index(sequences))
+    else:
+        raise Exception('[index_patterns] Unsupported engine: {0}'.format(engine))
+
+    return matchtables
+
+
+# Sequence sets and options shared with the worker processes
+_worker_args = {}
+
+
+def _init_worker(pset, nset, reverse_complement, engine, compact):
+    _worker_args.update({
+        'pset': pset,
+        'nset': nset,
+        'reverse_complement': reverse_complement,
+        'engine': engine,
+        'compact': compact,
+    })
+
+
+def _index_patterns_worker(sequences):
+    return index_patterns(sequences, **_worker_args)
+
+
+def build_matchtables(pattern_set, pset, nset, engine='kmer', cpu=1, compact=False, cache=None):
+    """Build the positive-set and negative-set match tables of every
+    pattern in a PatternSet
+
+    With cpu > 1 the patterns are split into one chunk per process and
+    indexed by a multiprocessing pool. The chunks are merged back in
+    order, so the match tables do not depend on the number of CPUs.
+    cache: MatchTableCache the tables are loaded from when present and
+    stored into otherwise"""
+    assert cpu > 0
+
+    reverse_complement = pattern_set.reverse_complement
+    patterns = list(pattern_set)
+
+    if cache is not None:
+        # Only the patterns missing from the cache are indexed
+        for pattern in patterns:
+            pattern.matchtable_pset = cache.get(pattern.sequence, pset, reverse_complement, compact)
+            pattern.matchtable_nset = cache.get(pattern.sequence, nset, reverse_complement, compact,
+                                                count_only=True)
+        patterns = [x for x in patterns if x.matchtable_pset is None or x.matchtable_nset is None]
+        count('matchtable_cache_hits', len(pattern_set) - len(patterns))
+
+    sequences = [pattern.sequence for pattern in patterns]
+
+    if cpu > 1 and len(sequences) > 1:
+        chunk_size = -(-len(sequences) // cpu)
+        chunks = [sequences[i: i + chunk_size] for i in xrange(0, len(sequences), chunk_size)]
+        pool = Pool(len(chunks), _init_worker, (pset, nset, reverse_complement, engine, compact))
+        try:
+            matchtables = []
+            for results in pool.map(_index_patterns_worker, chunks):
+                for mt_p, mt_n in results:
+                    mt_p.attach(pset)
+                    mt_n.attach(nset)
+                matchtables.extend(results)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        matchtables = index_patterns(sequences, pset, nset, reverse_complement, engine, compact)
+
+    count('patterns_indexed', len(sequences))
+    count('sites_indexed', sum(mt_p.n_hitsites for mt_p, mt_n in matchtables))
+    for pattern, (mt_p, mt_n) in zip(patterns, matchtables):
+        pattern.matchtable_pset = mt_p
+        pattern.matchtable_nset = mt_n
+        if cache is not None:
+            cache.put(pattern.sequence, pset, mt_p)
+            cache.put(pattern.sequence, nset, mt_n)
+
+    if cache is not None:
+        cache.evict()
+
+    return pattern_set
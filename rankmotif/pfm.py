@@ -1,11 +1,34 @@
 import argparse
+import numpy as np
 from math import sqrt
 from basic import Pattern
 from seqio import revcomp
+from profiling import profiled
 
 
-def pfm(pattern_sequence):
-    """Claculate position frequency matrix (PFM) of matching sequences"""
+def pfm(pattern_sequence, reverse=False):
+    """Claculate position frequency matrix (PFM) of matching sequences
+
+    The PFMs of a Pattern are cached in its positive-set match table
+    until the table is rebuilt.
+    reverse: return the reverse-complement PFM (see reverse_pfm)"""
+    if isinstance(pattern_sequence, Pattern):
+        cache = pattern_sequence.matchtable_pset.pfm_cache
+        if 'pfm' not in cache:
+            matrix = _pfm(pattern_sequence)
+            cache.update({'pfm': matrix, 'reverse': reverse_pfm(matrix)})
+        if reverse:
+            return cache.get('reverse')
+        else:
+            return cache.get('pfm')
+
+    if reverse:
+        return reverse_pfm(_pfm(pattern_sequence))
+    else:
+        return _pfm(pattern_sequence)
+
+
+def _pfm(pattern_sequence):
     if isinstance(pattern_sequence, Pattern):
         sequences = []
         for match_sequences in pattern_sequence.matchtable_pset.match_sequences.itervalues():
@@ -41,8 +64,11 @@ def pfm(pattern_sequence):
     return matrix
 
 
-def simpfm(pfm_1, pfm_2, gc_content, max_wsize=None, reverse_complement=False):
-    """Calculate the similarity scores of two PFMs and return the top one"""
+@profiled('simpfm')
+def simpfm(pfm_1, pfm_2, gc_content, max_wsize=None, reverse_complement=False, rv_pfm_2=None):
+    """Calculate the similarity scores of two PFMs and return the top one
+
+    rv_pfm_2: precomputed reverse_pfm(pfm_2)"""
     len_pfm_1 = len(pfm_1.get('a'))
     len_pfm_2 = len(pfm_2.get('a'))
 
@@ -83,7 +109,10 @@ def simpfm(pfm_1, pfm_2, gc_content, max_wsize=None, reverse_complement=False):
                 max_score = score
 
     if reverse_complement:
-        pfm_2 = reverse_pfm(pfm_2)
+        if rv_pfm_2:
+            pfm_2 = rv_pfm_2
+        else:
+            pfm_2 = reverse_pfm(pfm_2)
 
         for i in xrange(alnlen - len_pfm_1 + 1):
             for j in xrange(alnlen - len_pfm_2 + 1):
@@ -118,6 +147,226 @@ def simpfm(pfm_1, pfm_2, gc_content, max_wsize=None, reverse_complement=False):
         return [(1, 'pfm_1'), (1, 'pfm_2'), max_score]
 
 
+@profiled('simpfm_array')
+def simpfm_array(pfm_1, pfm_2, gc_content, max_wsize=None, reverse_complement=False,
+                 rv_pfm_2=None):
+    """NumPy version of simpfm with the same arguments and results
+
+    Every distinct relative shift of the two PFMs (on both strands) is
+    scored once, in a single batched computation."""
+    m1 = pfm_array(pfm_1)
+    m2 = pfm_array(pfm_2)
+    if reverse_complement:
+        if rv_pfm_2 is not None:
+            m2 = np.array([m2, pfm_array(rv_pfm_2)])
+        else:
+            m2 = np.array([m2, reverse_pfm_array(m2)])
+    else:
+        m2 = m2[np.newaxis]
+
+    shifts, strands = simpfm_shifts(len(m1), m2.shape[1], max_wsize, reverse_complement)
+    max_score = 0
+    if len(shifts):
+        scores = simpfm_shift_scores(m1[np.newaxis], m2[np.newaxis], shifts, strands, gc_content)
+        if scores.max() > max_score:
+            max_score = float(scores.max())
+
+    if reverse_complement:
+        return [(1, 'pfm_1'), (2, 'pfm_2'), max_score]
+    else:
+        return [(1, 'pfm_1'), (1, 'pfm_2'), max_score]
+
+
+@profiled('simpfm_matrix')
+def simpfm_matrix(pfms_1, pfms_2, gc_content, max_wsize=None, reverse_complement=False,
+                  max_block_size=2 ** 21, min_score=None, stats=None):
+    """Calculate the simpfm scores of all pairs of PFMs from pfms_1
+    and pfms_2 and return them as a len(pfms_1) x len(pfms_2) array
+
+    Pairs of PFMs with the same lengths share their alignment shifts
+    and are scored together, in blocks of at most max_block_size array
+    elements so that memory stays bounded.
+
+    min_score: skip the shifts and the pairs whose upper bound (see
+    simpfm_bounds) is below min_score. Scores reaching min_score are
+    exact, the others are only known to be lower (pruned pairs get 0).
+    stats: dict in which the numbers of pairs and shifts scored and
+    pruned are accumulated"""
+    m1s = [pfm_array(x) for x in pfms_1]
+    m2s = [pfm_array(x) for x in pfms_2]
+    matrix = np.zeros((len(m1s), len(m2s)))
+    if stats is None:
+        stats = {}
+    for i in ['pairs', 'pairs_pruned', 'shifts', 'shifts_pruned']:
+        stats.setdefault(i, 0)
+
+    groups = {}
+    for i, m1 in enumerate(m1s):
+        for j, m2 in enumerate(m2s):
+            groups.setdefault((len(m1), len(m2)), []).append((i, j))
+
+    for (len_1, len_2), pairs in groups.iteritems():
+        shifts, strands = simpfm_shifts(len_1, len_2, max_wsize, reverse_complement)
+        if not len(shifts):
+            continue
+        width = (np.maximum(len_1, shifts + len_2) - np.minimum(shifts, 0)).max()
+        n_pairs = max(1, max_block_size // (len(shifts) * width * 4))
+        for k in xrange(0, len(pairs), n_pairs):
+            block = pairs[k: k + n_pairs]
+            block_1 = np.array([m1s[i] for i, j in block])
+            if reverse_complement:
+                block_2 = np.array([[m2s[j], reverse_pfm_array(m2s[j])] for i, j in block])
+            else:
+                block_2 = np.array([[m2s[j]] for i, j in block])
+            stats['pairs'] += len(block)
+            stats['shifts'] += len(block) * len(shifts)
+            rows, columns = zip(*block)
+
+            if min_score is None:
+                scores = simpfm_shift_scores(block_1, block_2, shifts, strands, gc_content)
+                matrix[rows, columns] = np.maximum(scores.max(axis=1), 0)
+                continue
+
+            # Allow for the rounding of the bounds
+            viable = simpfm_bounds(block_1, block_2, shifts, strands, gc_content) >= min_score - 1e-9
+            stats['pairs_pruned'] += len(block) - viable.any(axis=1).sum()
+            stats['shifts_pruned'] += viable.size - viable.sum()
+            index, viable_shifts = np.nonzero(viable)
+            if not len(index):
+                continue
+            scores = np.zeros(len(block))
+            np.maximum.at(scores, index, simpfm_shift_scores(
+                block_1, block_2, shifts[viable_shifts], strands[viable_shifts], gc_content, index))
+            matrix[rows, columns] = scores
+
+    return matrix
+
+
+def simpfm_bounds(m1, m2, shifts, strands, gc_content):
+    """Upper bounds of the scores of simpfm_shift_scores (same arguments)
+
+    A column covered by only one PFM is scored exactly against the
+    background; any other column scores at most 1."""
+    len_1 = m1.shape[1]
+    len_2 = m2.shape[2]
+    starts = np.minimum(shifts, 0)
+    widths = np.maximum(len_1, shifts + len_2) - starts
+
+    zeros = np.zeros(m1.shape[0])
+    cumsum_1 = np.column_stack([zeros, np.cumsum(background_scores(m1, gc_content), axis=1)])
+    cumsum_2 = np.concatenate([
+        np.zeros(m2.shape[:2] + (1,)), np.cumsum(background_scores(m2, gc_content), axis=2)], axis=2)
+
+    # Columns of pfm_1 outside pfm_2: [0, left_1) and [right_1, len_1)
+    left_1 = np.clip(shifts, 0, len_1)
+    right_1 = np.clip(shifts + len_2, 0, len_1)
+    # Columns of pfm_2 outside pfm_1: [0, left_2) and [right_2, len_2)
+    left_2 = np.clip(-shifts, 0, len_2)
+    right_2 = np.clip(len_1 - shifts, 0, len_2)
+
+    n_outside = left_1 + len_1 - right_1 + left_2 + len_2 - right_2
+    outside = (cumsum_1[:, left_1] + cumsum_1[:, [len_1]] - cumsum_1[:, right_1] +
+               cumsum_2[:, strands, left_2] + cumsum_2[:, strands, len_2] -
+               cumsum_2[:, strands, right_2])
+
+    return (widths - n_outside + outside) / widths
+
+
+def background_scores(m, gc_content):
+    """Score each column of PFM arrays against the background of
+    gc_content, as simpfm_scoring does"""
+    at = (1 - gc_content) / 2
+    cg = gc_content / 2
+    d = np.power(m - np.array([at, at, cg, cg]), 2)
+    s = d[..., 0] + d[..., 1] + d[..., 2] + d[..., 3]
+    return 1 - np.sqrt(s) / sqrt(2)
+
+
+def simpfm_shifts(len_pfm_1, len_pfm_2, max_wsize=None, reverse_complement=False):
+    """Return the distinct offsets of pfm_2 relative to pfm_1 that
+    simpfm aligns, and the strand (0: pfm_2, 1: its reverse
+    complement) of each"""
+    assert not max_wsize or max_wsize > 0
+
+    min_pfm_len = min(len_pfm_1, len_pfm_2)
+    if not max_wsize or max_wsize > min_pfm_len:
+        max_wsize = min_pfm_len - 2
+    alnlen = len_pfm_1 + len_pfm_2 - max_wsize
+
+    shifts = np.arange(-(alnlen - len_pfm_1), alnlen - len_pfm_2 + 1)
+    strands = np.zeros(len(shifts), dtype=np.int64)
+    if reverse_complement:
+        shifts = np.concatenate([shifts, shifts])
+        strands = np.concatenate([strands, strands + 1])
+
+    return (shifts, strands)
+
+
+def simpfm_shift_scores(m1, m2, shifts, strands, gc_content, index=None):
+    """Score the alignments of m1[g] with m2[g, strands[k]] shifted by
+    shifts[k] and return a G x K array
+
+    m1 is a G x L1 x 4 stack of PFM arrays and m2 a G x S x L2 x 4
+    stack. The columns of the alignment not covered by one of the PFMs
+    are compared against the background of gc_content, as in
+    expand_pfm. The arithmetic is done in the same order as
+    simpfm_scoring so the scores are identical.
+
+    index: score only the alignment k of the pair index[k] and return
+    the K scores"""
+    len_1 = m1.shape[1]
+    len_2 = m2.shape[2]
+    n_shifts = len(shifts)
+    shared = index is None
+    if shared:
+        index = np.repeat(np.arange(m1.shape[0]), n_shifts)
+        shifts = np.tile(shifts, m1.shape[0])
+        strands = np.tile(strands, m1.shape[0])
+    starts = np.minimum(shifts, 0)
+    widths = np.maximum(len_1, shifts + len_2) - starts
+    pad = widths.max()
+    at = (1 - gc_content) / 2
+    cg = gc_content / 2
+    background = np.array([at, at, cg, cg])
+
+    padded_1 = np.empty((m1.shape[0], len_1 + 2 * pad, 4))
+    padded_1[:] = background
+    padded_1[:, pad: pad + len_1] = m1
+    padded_2 = np.empty((m2.shape[0], m2.shape[1], len_2 + 2 * pad, 4))
+    padded_2[:] = background
+    padded_2[:, :, pad: pad + len_2] = m2
+
+    columns = np.arange(pad)
+    p1 = padded_1[index[:, np.newaxis], (pad + starts)[:, np.newaxis] + columns]
+    p2 = padded_2[index[:, np.newaxis], strands[:, np.newaxis],
+                  (pad + starts - shifts)[:, np.newaxis] + columns]
+    d = np.power(p1 - p2, 2)
+    s = d[..., 0] + d[..., 1] + d[..., 2] + d[..., 3]
+    scores = 1 - np.sqrt(s) / sqrt(2)
+
+    # Columns beyond the width of an alignment come after it in the
+    # cumulative sum and do not change its total
+    totals = np.cumsum(scores, axis=1)[np.arange(len(shifts)), widths - 1]
+    scores = totals / widths
+
+    if shared:
+        return scores.reshape((-1, n_shifts))
+    else:
+        return scores
+
+
+def pfm_array(pfm):
+    """Convert a PFM dict into an L x 4 array (columns a, t, c, g)"""
+    if isinstance(pfm, np.ndarray):
+        return pfm
+    return np.array([pfm.get('a'), pfm.get('t'), pfm.get('c'), pfm.get('g')], dtype=np.float64).T
+
+
+def reverse_pfm_array(pfm):
+    """Reverse-complement counterpart of a PFM array (see reverse_pfm)"""
+    return pfm[::-1, [1, 0, 3, 2]]
+
+
 def expand_pfm(pfm, left_length, right_length, gc_content):
     at = (1 - gc_content) / 2
     cg = gc_content / 2
@@ -163,6 +412,8 @@ def main():
     parser.add_argument('-r', action='store_true')
     parser.add_argument('-ws', type=int, default=7, metavar='<int>',
                         help='maximum window size of simpfm (default: 7)')
+    parser.add_argument('-engine', choices=['python', 'numpy'], default='numpy',
+                        help='implementation of simpfm (default: numpy)')
     args = parser.parse_args()
 
     pfm1 = {}
@@ -179,7 +430,11 @@ def main():
         for i in ['a', 't', 'c', 'g']:
             pfm2.update({i: [float(x) for x in fi.readline().split('\t')]})
 
-    simpfm_score = simpfm(pfm1, pfm2, args.gc, max_wsize=args.ws, reverse_complement=args.r)
+    if args.engine == 'numpy':
+        simpfm_func = simpfm_array
+    else:
+        simpfm_func = simpfm
+    simpfm_score = simpfm_func(pfm1, pfm2, args.gc, max_wsize=args.ws, reverse_complement=args.r)
     print(simpfm_score)
 
 
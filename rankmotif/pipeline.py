@@ -0,0 +1,392 @@
+import os
+import gzip
+import json
+import logging
+from heapq import heappush, heappushpop
+from contextlib import contextmanager
+from itertools import islice
+from .basic import Pattern, PatternSet, merge_patterns
+from .indexing import build_matchtables
+from .scoring import PreferentialOccurrence, PatternScoring, parse_base_score
+from .ranking import Cluster
+from .pfm import pfm
+from .profiling import stage, staged, count
+from .seqio import revcomp, SequenceSet
+
+
+class Dataset(object):
+    """Sequence sets and base scores that ranking jobs share
+
+    pset, nset: FASTA files (or SequenceSets) of the positive and the
+    negative set
+    oc, cs: nucleosome occupancy and conservation score files (or
+    BaseScores)
+    score_cache: see parse_base_score"""
+
+    def __init__(self, pset, nset, oc=None, cs=None, score_cache=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        with stage('load'):
+            self._logger.info('loading sequence sets')
+            if isinstance(pset, SequenceSet):
+                self.pset = pset
+            else:
+                self.pset = SequenceSet(pset)
+            if isinstance(nset, SequenceSet):
+                self.nset = nset
+            else:
+                self.nset = SequenceSet(nset)
+            count('sequence_bytes_loaded', len(self.pset.data) + len(self.nset.data))
+
+            if oc or cs:
+                self._logger.info('loading base scores')
+            self.oc = parse_base_score(oc, cache=score_cache)
+            self.cs = parse_base_score(cs, cache=score_cache)
+
+
+def rank(dataset, sequences, reverse_complement=False, sp_weight=1, sn_weight=1, sc_weight=1,
+         max_cluster=5, max_patterns_per_cluster=5, simpfm_max_wsize=None, gc=None,
+         seqmask=False, engine='kmer', cpu=1, compact=False, cache=None, prefilter=None,
+         chunk_size=10000):
+    """Score and cluster the pattern sequences against a Dataset and
+    return the Cluster
+
+    prefilter: only score and cluster the prefilter patterns with the
+    highest z-scores (see select_patterns)"""
+    pattern_scoring = score_patterns(dataset, sequences, reverse_complement, sp_weight,
+                                     sn_weight, sc_weight, seqmask, engine=engine, cpu=cpu,
+                                     compact=compact, cache=cache, prefilter=prefilter,
+                                     chunk_size=chunk_size)
+
+    return cluster_patterns(dataset, pattern_scoring, reverse_complement, max_cluster,
+                            max_patterns_per_cluster, simpfm_max_wsize, gc)
+
+
+def sweep(dataset, pattern_scoring, weights, reverse_complement=False, max_cluster=5,
+          max_patterns_per_cluster=5, simpfm_max_wsize=None, gc=None):
+    """Cluster the patterns of a PatternScoring (see score_patterns) for
+    each (sp_weight, sn_weight, sc_weight) of weights, and yield the
+    weights and the Cluster
+
+    The match tables and the component scores are only built once;
+    the pattern scores are recomputed for each weights (see
+    PatternScoring.reweight)."""
+    for sp_weight, sn_weight, sc_weight in weights:
+        pattern_scoring.reweight(sp_weight, sn_weight, sc_weight)
+        yield ((sp_weight, sn_weight, sc_weight),
+               cluster_patterns(dataset, pattern_scoring, reverse_complement, max_cluster,
+                                max_patterns_per_cluster, simpfm_max_wsize, gc))
+
+
+def score_patterns(dataset, sequences, reverse_complement=False, sp_weight=1, sn_weight=1,
+                   sc_weight=1, seqmask=False, engine='kmer', cpu=1, compact=False, cache=None,
+                   prefilter=None, chunk_size=10000):
+    """Build the match tables of the pattern sequences against a Dataset
+    and return the PatternScoring of the patterns (see rank)"""
+    assert isinstance(dataset, Dataset)
+    logger = logging.getLogger('rank')
+
+    pattern_scoring = PatternScoring(sp_weight=sp_weight, sn_weight=sn_weight,
+                                     sc_weight=sc_weight)
+
+    with stage('matchtables'):
+        logger.info('building match tables of patterns')
+        if prefilter:
+            pattern_set = select_patterns(dataset, sequences, pattern_scoring, prefilter,
+                                          reverse_complement, chunk_size, engine=engine, cpu=cpu,
+                                          compact=compact, cache=cache)
+        else:
+            pattern_set = PatternSet(reverse_complement)
+            for sequence in sequences:
+                pattern_set.add(Pattern(sequence))
+            build_matchtables(pattern_set, dataset.pset, dataset.nset, engine=engine, cpu=cpu,
+                              compact=compact, cache=cache)
+        if cache is not None:
+            logger.info('match table cache: {0} hits, {1} misses'.format(cache.hits,
+                                                                         cache.misses))
+
+    with stage('scoring'):
+        # The sites of the selected patterns are counted by select_patterns
+        pattern_scoring.build(pattern_set, append=bool(prefilter), seqmask=seqmask,
+                              nuclocc=dataset.oc, consv=dataset.cs, counted=bool(prefilter))
+
+    return pattern_scoring
+
+
+def cluster_patterns(dataset, pattern_scoring, reverse_complement=False, max_cluster=5,
+                     max_patterns_per_cluster=5, simpfm_max_wsize=None, gc=None):
+    """Cluster the scored patterns and return the Cluster (see rank)"""
+    with stage('clustering'):
+        cluster = Cluster(max_cluster, 0.8, max_patterns_per_cluster, simpfm_max_wsize,
+                          reverse_complement)
+        cluster.run(pattern_scoring, gc=gc, pset=dataset.pset)
+
+    _check_discarded(pattern_scoring, cluster)
+
+    return cluster
+
+
+def _check_discarded(pattern_scoring, cluster):
+    """Warn when the patterns left out by select_patterns might change
+    the clusters
+
+    The clusters are the ones of the exhaustive run when the clustering
+    stopped before the last scored pattern and the bound of the pattern
+    scores of the patterns left out (see
+    PatternScoring.discarded_bound) is below the score of the last
+    pattern it looked at: the patterns left out would all be ranked
+    after that one."""
+    bound = pattern_scoring.discarded_bound()
+    if bound is None:
+        return
+    logger = logging.getLogger('rank')
+
+    if cluster.last_examined is None or cluster.exhausted:
+        logger.warning('the clustering reached the last selected pattern; the patterns left '
+                       'out by the prefilter might change the clusters, use a larger prefilter')
+        return
+
+    last_score = pattern_scoring.results.get(cluster.last_examined)
+    if bound >= last_score:
+        logger.warning('the patterns left out by the prefilter may score up to {0}, not below '
+                       'the score {1} of the last pattern the clustering looked at; they might '
+                       'change the clusters, use a larger prefilter'.format(bound, last_score))
+    else:
+        logger.info('the patterns left out by the prefilter score at most {0}, below the score '
+                    '{1} of the last pattern the clustering looked at'.format(bound, last_score))
+
+
+def select_patterns(dataset, sequences, pattern_scoring, prefilter, reverse_complement=False,
+                    chunk_size=10000, **kwargs):
+    """Return a PatternSet of the prefilter patterns with the highest
+    z-scores (PreferentialOccurrence, ties broken by pattern sequence)
+
+    The pattern sequences are read and indexed in chunks of chunk_size.
+    The sites of every pattern are counted into pattern_scoring, so the
+    position scores of the selected patterns are the same as in a run
+    with all patterns; the match tables of the other patterns are
+    dropped as soon as they fall out of the selection. Only the selected
+    patterns and the distinct pattern sequences are kept in memory.
+
+    The pattern scores are the z-scores weighted by the position,
+    occupancy and conservation scores, so a pattern outside of the
+    selection can still rank high or join a cluster. The patterns left
+    out are recorded in pattern_scoring (see PatternScoring.discard);
+    cluster_patterns checks that none of them could have reached the
+    ranks the clustering looked at, and warns otherwise.
+
+    kwargs: options of build_matchtables"""
+    assert prefilter > 0
+    logger = logging.getLogger('select_patterns')
+
+    # Selected patterns as a min-heap of [z_score, sequence, pattern]
+    # entries, and the entry of each distinct sequence (None once it is
+    # dropped)
+    heap = []
+    entries = {}
+
+    n_patterns = 0
+    sequences = iter(sequences)
+    while True:
+        chunk = PatternSet(reverse_complement)
+        for sequence in islice(sequences, chunk_size):
+            chunk.add(Pattern(sequence))
+        if not len(chunk):
+            break
+
+        build_matchtables(chunk, dataset.pset, dataset.nset, **kwargs)
+        z_scores = PreferentialOccurrence().build(chunk).results
+
+        # As in PatternSet, a later pattern replaces an earlier one with
+        # the same sequence (or reverse complement); their sites are
+        # counted once
+        new_patterns = PatternSet(reverse_complement)
+        for pattern in chunk:
+            key = pattern.sequence
+            if reverse_complement and key not in entries and revcomp(key) in entries:
+                key = revcomp(key)
+            if key in entries:
+                if entries.get(key) is not None:
+                    entries.get(key)[2] = pattern
+                continue
+
+            n_patterns += 1
+            new_patterns.add(pattern)
+            entry = [z_scores.get(pattern), pattern.sequence, pattern]
+            entries.update({key: entry})
+            if len(heap) < prefilter:
+                heappush(heap, entry)
+                continue
+            if entry[:2] > heap[0][:2]:
+                entry = heappushpop(heap, entry)
+                key = entry[1]
+            entries.update({key: None})
+            pattern_scoring.discard(entry[2], entry[0])
+
+        pattern_scoring.count(new_patterns)
+
+    logger.info('selected {0} of {1} patterns'.format(len(heap), n_patterns))
+
+    pattern_set = PatternSet(reverse_complement)
+    for z_score, sequence, pattern in heap:
+        pattern_set.add(pattern)
+
+    return pattern_set
+
+
+@staged('merging')
+def collect_results(cluster, pset, reverse_complement=False):
+    """Merge the patterns of each cluster and return the tables that
+    write_results writes, as a dict:
+
+        clustered_patterns: (cluster_no, pattern, pset_support)
+        merged_patterns: (cluster_no, strand, pattern, pset_support)
+        match_sequences: (cluster_no, gene_name, start, sequence, strand)
+        cluster_support: (cluster_no, pset_support)
+        pfms: (cluster_no, PFM of the match sequences)"""
+    logger = logging.getLogger('collect_results')
+    logger.info('merging patterns and calculating PFMs')
+
+    results = {
+        'clustered_patterns': [],
+        'merged_patterns': [],
+        'match_sequences': [],
+        'cluster_support': [],
+        'pfms': [],
+    }
+
+    merseq_support = {}
+    pset_n_seqs = 0
+    for i, j in sorted(cluster.results.iteritems()):
+        for p in j:
+            pset_support = float(p.matchtable_pset.n_hitseqs) / p.matchtable_pset.n_seqs
+            pset_n_seqs = p.matchtable_pset.n_seqs
+            results.get('clustered_patterns').append((i, p.sequence.upper(), round(pset_support, 2)))
+
+        merged = merge_patterns(j, reverse_complement)
+        match_sequences = merged.extract_match_info(pset)
+
+        for p in merged.patterns:
+            strand = merged._strands.get(p)
+            if strand == 1:
+                strand = '+'
+            else:
+                strand = '-'
+            pset_support = float(p.matchtable_pset.n_hitseqs) / p.matchtable_pset.n_seqs
+
+            if i in merseq_support:
+                merseq_support[i] |= set(p.matchtable_pset.match_sequences.keys())
+            else:
+                merseq_support.update({i: set(p.matchtable_pset.match_sequences.keys())})
+
+            results.get('merged_patterns').append(
+                (i, strand, p.sequence.upper(), round(pset_support, 2)))
+
+        for gene_name, strand, start, seq in match_sequences:
+            if strand == 1:
+                strand = '+'
+            else:
+                strand = '-'
+            results.get('match_sequences').append((i, gene_name, start, seq.upper(), strand))
+
+        results.get('pfms').append((i, pfm([x[3] for x in match_sequences])))
+
+    for i, j in sorted(merseq_support.iteritems()):
+        results.get('cluster_support').append((i, round(float(len(j)) / pset_n_seqs, 2)))
+
+    return results
+
+
+# Columns of the tables of collect_results, as written in the headers
+# of the result files
+COLUMNS = {
+    'clustered_patterns': ['cluster_no', 'pattern', 'pset_support'],
+    'merged_patterns': ['cluster_no', 'strand', 'pattern', 'pset_support'],
+    'match_sequences': ['cluster_no', 'gene_name', 'start', 'sequence', 'strand'],
+    'cluster_support': ['cluster_no', 'pset_support'],
+}
+
+
+class ResultWriter(object):
+    """Write the tables of collect_results into an output directory
+
+    Each table is written to its file through a buffer of buffer_size
+    bytes instead of line by line. With the default options the files
+    are the same as the ones rankMotif.py has always written.
+
+    compress: gzip the files (their names get a .gz suffix)
+    json_file: also write every table into results.json, as an object
+    of columns (the lists of the values of each column of COLUMNS) per
+    table; the PFMs are the columns cluster_no, a, t, c and g"""
+
+    def __init__(self, out, compress=False, json_file=False, buffer_size=1048576):
+        self.out = out
+        self.compress = compress
+        self.json_file = json_file
+        self.buffer_size = buffer_size
+
+    def write(self, results):
+        if not os.path.exists(self.out):
+            os.makedirs(self.out)
+
+        for name in ['clustered_patterns', 'merged_patterns', 'match_sequences']:
+            with self._open(name + '.txt') as fo:
+                fo.write('\t'.join(COLUMNS.get(name)) + '\n')
+                for row in results.get(name):
+                    fo.write('\t'.join([str(i) for i in row]) + '\n')
+
+        for i, j in results.get('pfms'):
+            with self._open('cluster_{0}.pfm.txt'.format(i)) as fo:
+                fo.write('cluster_{0}\t{1}\n'.format(i, str(len(j.get('a')))))
+                for base in ['a', 't', 'c', 'g']:
+                    fo.write('\t'.join([str(k) for k in j.get(base)]) + '\n')
+
+        with self._open('cluster_support.txt') as fo:
+            fo.write('\t'.join(COLUMNS.get('cluster_support')) + '\n')
+            for i, j in results.get('cluster_support'):
+                fo.write('{0}\t{1}\n'.format(i, j))
+
+        if self.json_file:
+            tables = {}
+            for name, columns in COLUMNS.iteritems():
+                rows = results.get(name)
+                tables.update({name: dict(
+                    (column, [row[k] for row in rows]) for k, column in enumerate(columns))})
+            tables.update({'pfms': {'cluster_no': [i for i, j in results.get('pfms')]}})
+            for base in ['a', 't', 'c', 'g']:
+                tables.get('pfms').update({base: [j.get(base) for i, j in results.get('pfms')]})
+
+            with self._open('results.json') as fo:
+                json.dump(tables, fo, sort_keys=True)
+
+    @contextmanager
+    def _open(self, fname):
+        fpath = os.path.join(self.out, fname)
+        if self.compress:
+            with open(fpath + '.gz', 'wb', self.buffer_size) as fo:
+                with gzip.GzipFile(fname, 'wb', fileobj=fo) as gz:
+                    yield gz
+        else:
+            with open(fpath, 'w', self.buffer_size) as fo:
+                yield fo
+
+
+def write_pattern_scores(pattern_scoring, fpath):
+    """Write the component scores of the patterns (see
+    PatternScoring.table) into a tab-separated file"""
+    table = pattern_scoring.table()
+    columns = [x for x in ['z_score', 'position', 'occupancy', 'conservation']
+               if table.get(x) is not None]
+
+    with open(fpath, 'w', 1048576) as fo:
+        fo.write('\t'.join(['pattern'] + columns) + '\n')
+        for i, pattern in enumerate(table.get('pattern')):
+            fo.write('\t'.join([pattern.sequence.upper()] +
+                                [repr(float(table.get(x)[i])) for x in columns]) + '\n')
+
+
+@staged('output')
+def write_results(results, out, compress=False, json_file=False):
+    """Write the tables of collect_results into the output directory
+    (see ResultWriter)"""
+    ResultWriter(out, compress, json_file).write(results)
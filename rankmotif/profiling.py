@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import cProfile
+import resource
+import functools
+from contextlib import contextmanager
+
+# The Profiler that records the stages, calls and counters; None when
+# profiling is off
+_profiler = None
+
+
+def enable(profiler):
+    """Make profiler record the instrumented code"""
+    global _profiler
+    assert isinstance(profiler, Profiler)
+    _profiler = profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def active():
+    """Return the Profiler in use, or None"""
+    return _profiler
+
+
+@contextmanager
+def stage(name):
+    """Record the enclosed block as a stage of the active Profiler"""
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.stage(name):
+            yield
+
+
+def staged(name):
+    """Decorator running every call of a function as a stage (see
+    stage)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """Add n to a counter of the active Profiler"""
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+def profiled(name):
+    """Decorator recording the calls of a function in the active
+    Profiler under name; a plain call when profiling is off"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.add_call(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def current_rss():
+    """Resident set size of the process in bytes, or None where
+    /proc is not available"""
+    try:
+        with open('/proc/self/statm', 'r') as fi:
+            return int(fi.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler(object):
+    """Timings, call counts and memory of the pipeline stages and of the
+    instrumented functions, and counters of the work done
+
+    A stage is a block run under stage(name); stages run again (or
+    nested in one another) add up under their name. Each stage records
+    its wall time, its number of runs, the change of the resident set
+    size over its runs and the peak resident set size at its end. Calls
+    of the functions decorated by profiled() record their number and
+    their total wall time.
+
+    The Profiler records while it is enabled, or inside a with block:
+
+        with Profiler() as profiler:
+            cluster = rank(dataset, sequences)
+        profiler.save('profile.json')
+
+    Only the current process is recorded; work done by the worker
+    processes of build_matchtables (cpu > 1) shows in the stage that
+    started them but not in the calls and counters.
+
+    cprofile_dir: also run cProfile over each outermost stage and dump
+    its statistics to <cprofile_dir>/<stage>.prof"""
+
+    def __init__(self, cprofile_dir=None):
+        self.cprofile_dir = cprofile_dir
+        self.stages = {}
+        self.functions = {}
+        self.counters = {}
+        self._order = []
+        self._depth = 0
+        self._cprofiles = {}
+        self._start = time.time()
+
+    def __enter__(self):
+        enable(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        disable()
+
+    @contextmanager
+    def stage(self, name):
+        if name not in self.stages:
+            self._order.append(name)
+            self.stages.update({name: {'calls': 0, 'time': 0.0, 'rss_delta': 0}})
+
+        cprofile = None
+        if self.cprofile_dir and not self._depth:
+            cprofile = self._cprofiles.setdefault(name, cProfile.Profile())
+
+        rss = current_rss()
+        self._depth += 1
+        start = time.time()
+        if cprofile is not None:
+            cprofile.enable()
+        try:
+            yield
+        finally:
+            if cprofile is not None:
+                cprofile.disable()
+            elapsed = time.time() - start
+            self._depth -= 1
+
+            record = self.stages.get(name)
+            record['calls'] += 1
+            record['time'] += elapsed
+            if rss is not None:
+                record['rss_delta'] += current_rss() - rss
+            record['peak_rss'] = peak_rss()
+
+            if cprofile is not None:
+                self._dump_cprofile(name, cprofile)
+
+    def add_call(self, name, elapsed):
+        record = self.functions.get(name)
+        if record is None:
+            record = {'calls': 0, 'time': 0.0}
+            self.functions.update({name: record})
+        record['calls'] += 1
+        record['time'] += elapsed
+
+    def count(self, name, n=1):
+        self.counters.update({name: self.counters.get(name, 0) + n})
+
+    def results(self):
+        """Return the records as a dict (the content of save); memory
+        is in MB"""
+        stages = []
+        for name in self._order:
+            record = self.stages.get(name)
+            stages.append({
+                'name': name,
+                'calls': record.get('calls'),
+                'time': record.get('time'),
+                'rss_delta_mb': record.get('rss_delta') / 1048576.0,
+                'peak_rss_mb': record.get('peak_rss', 0) / 1048576.0,
+            })
+
+        functions = {}
+        for name, record in self.functions.iteritems():
+            functions.update({name: {'calls': record.get('calls'), 'time': record.get('time')}})
+
+        return {
+            'time': time.time() - self._start,
+            'peak_rss_mb': peak_rss() / 1048576.0,
+            'stages': stages,
+            'functions': functions,
+            'counters': dict(self.counters),
+        }
+
+    def save(self, fpath):
+        """Write the records to a JSON file"""
+        with open(fpath, 'w') as fo:
+            json.dump(self.results(), fo, indent=2, sort_keys=True, separators=(',', ': '))
+            fo.write('\n')
+
+    def _dump_cprofile(self, name, cprofile):
+        if not os.path.exists(self.cprofile_dir):
+            os.makedirs(self.cprofile_dir)
+        cprofile.dump_stats(os.path.join(self.cprofile_dir, '{0}.prof'.format(name)))
@@ -1,20 +1,32 @@
 import logging
 from .scoring import PatternScoring
 from .seqio import gc_content
-from .pfm import pfm, simpfm
+from .pfm import pfm, pfm_array, simpfm_matrix
+from .profiling import count
 
 
 class Cluster(object):
 
     def __init__(self, max_cluster=5, similarity=0.8,
-                 max_patterns_per_cluster=5, simpfm_max_wsize=None, reverse_complement=False):
+                 max_patterns_per_cluster=5, simpfm_max_wsize=None, reverse_complement=False,
+                 max_block_size=1024, prune=True):
         self._logger = logging.getLogger(self.__class__.__name__)
         self.max_cluster = max_cluster
         self.similarity = similarity
         self.max_patterns_per_cluster = max_patterns_per_cluster
         self.simpfm_max_wsize = simpfm_max_wsize
         self.reverse_complement = reverse_complement
+        # Maximum number of candidates scored against a seed at once
+        self.max_block_size = max_block_size
+        # Skip clustered patterns and candidates that cannot reach the
+        # similarity before scoring them; the clusters are the same
+        self.prune = prune
         self.results = {}
+        self.stats = {}
+        # Lowest-ranked pattern the last run looked at, and whether that
+        # was the last pattern of the ranking
+        self.last_examined = None
+        self.exhausted = False
 
     def run(self, pattern_scoring, gc=None, pset=None):
         isinstance(pattern_scoring, PatternScoring)
@@ -24,29 +36,75 @@ class Cluster(object):
 
         if not gc:
             gc = gc_content(pset)
+        # Ties are ordered by pattern sequence to keep the ranking reproducible
         ranked_patterns = sorted(
-            pattern_scoring.results, key=lambda x: pattern_scoring.results.get(x), reverse=True)
+            pattern_scoring.results, key=lambda x: (pattern_scoring.results.get(x), x.sequence),
+            reverse=True)
         clusters = [0] * len(pattern_scoring.results)
         n_clusters = 0
         n_patterns = {}
 
+        pfms = {}
+        self.stats = {'skipped': 0}
+        if self.prune:
+            min_score = self.similarity
+        else:
+            min_score = None
+        last = -1
         for i in xrange(len(ranked_patterns)):
             if n_clusters == self.max_cluster:
                 break
+            last = max(last, i)
             if clusters[i] == 0:
                 n_clusters += 1
                 clusters[i] = n_clusters
                 n_patterns.update({n_clusters: 0})
                 self.results.update({n_clusters: [ranked_patterns[i]]})
+
+                # Similarities of the seed with the following patterns,
+                # scored in blocks of growing size as far as needed
+                scores = {}
+                block_size = 16
                 for j in xrange(i + 1, len(ranked_patterns)):
                     if n_patterns.get(n_clusters) == self.max_patterns_per_cluster - 1:
                         break
-                    score = simpfm(
-                        pfm(ranked_patterns[i]), pfm(ranked_patterns[j]),
-                        gc, self.simpfm_max_wsize, self.reverse_complement)[2]
+                    last = max(last, j)
+                    if self.prune and clusters[j] != 0:
+                        self.stats['skipped'] += 1
+                        continue
+                    if j not in scores:
+                        block = []
+                        for k in xrange(j, len(ranked_patterns)):
+                            if len(block) == block_size:
+                                break
+                            if not self.prune or clusters[k] == 0:
+                                block.append(k)
+                        scores.update(zip(block, simpfm_matrix(
+                            [self._pfm(pfms, ranked_patterns[i])],
+                            [self._pfm(pfms, ranked_patterns[k]) for k in block],
+                            gc, self.simpfm_max_wsize, self.reverse_complement,
+                            min_score=min_score, stats=self.stats)[0]))
+                        block_size = min(block_size * 2, self.max_block_size)
+                    score = scores.pop(j)
                     if clusters[j] == 0 and score >= self.similarity:
                         clusters[j] = n_clusters
                         self.results.get(n_clusters).append(ranked_patterns[j])
                         n_patterns[n_clusters] += 1
 
+        self.last_examined = ranked_patterns[last] if last >= 0 else None
+        self.exhausted = last == len(ranked_patterns) - 1
+        self._logger.info(
+            'scored {0} pairs: {1} clustered patterns skipped, {2} pairs and {3} of {4} '
+            'shifts pruned'.format(
+                self.stats.get('pairs', 0), self.stats.get('skipped'),
+                self.stats.get('pairs_pruned', 0), self.stats.get('shifts_pruned', 0),
+                self.stats.get('shifts', 0)))
+        for key in ['pairs', 'pairs_pruned', 'shifts', 'shifts_pruned']:
+            count('simpfm_' + key, self.stats.get(key, 0))
+
         return self
+
+    def _pfm(self, pfms, pattern):
+        if pattern not in pfms:
+            pfms.update({pattern: pfm_array(pfm(pattern))})
+        return pfms.get(pattern)
@@ -1,6 +1,12 @@
+import os
+import errno
+import hashlib
 import logging
+import numpy as np
+from array import array
 from math import sqrt
 from .basic import PatternSet
+from .profiling import profiled, count
 
 
 class PreferentialOccurrence(object):
@@ -36,60 +42,189 @@ class PreferentialOccurrence(object):
 class PositionScoring(object):
 
     class _PositionScoreMatrix(object):
+        """Accumulated counts of the non-wildcard bases of all sites
 
-        def __init__(self):
-            self.matrix = {}
-
-        def add(self, seqid, indices):
-            for index in indices:
-                if seqid in self.matrix:
-                    if index in self.matrix.get(seqid):
-                        self.matrix.get(seqid)[index] += 1
-                    else:
-                        self.matrix.get(seqid).update({index: 1})
-                else:
-                    self.matrix.update({seqid: {index: 1}})
+        The counts are kept in one flat int32 array; the positions of
+        seqid k occupy matrix[offsets[k]:offsets[k + 1]]."""
 
-        def get(self, seqid, index):
-            if seqid not in self.matrix or index not in self.matrix.get(seqid):
-                return 0
-            else:
-                return self.matrix.get(seqid).get(index)
+        def __init__(self):
+            self.matrix = np.zeros(0, dtype=np.int32)
+            self.offsets = np.zeros(1, dtype=np.int64)
+
+        def add(self, seqids, positions, weights=None):
+            """weights: counts of the positions (default: 1 each)
+
+            The counts are added in place; the matrix is only laid out
+            again when a position lies beyond the row of its sequence."""
+            if not len(positions):
+                return
+            if weights is None:
+                weights = np.ones(len(positions), dtype=np.int64)
+
+            lengths = np.zeros(max(len(self.offsets) - 1, seqids.max() + 1), dtype=np.int64)
+            lengths[:len(self.offsets) - 1] = np.diff(self.offsets)
+            beyond = positions >= lengths[seqids]
+            if beyond.any():
+                # Rows that grow get at least twice their length, so that
+                # the matrix is rarely laid out again
+                grown = np.unique(seqids[beyond])
+                needed = lengths.copy()
+                np.maximum.at(needed, seqids[beyond], positions[beyond] + 1)
+                lengths[grown] = np.maximum(needed[grown], 2 * lengths[grown])
+                self._relayout(lengths)
+
+            # Summed per distinct index first; np.add.at is much slower
+            indices, inverse = np.unique(self.offsets[seqids] + positions, return_inverse=True)
+            self.matrix[indices] += np.bincount(inverse, weights=weights).astype(np.int32)
+
+        def _relayout(self, lengths):
+            """Grow the rows to the given lengths; the zeros are inserted
+            at the end of each row"""
+            n_rows = len(self.offsets) - 1
+            current_lengths = np.zeros(len(lengths), dtype=np.int64)
+            current_lengths[:n_rows] = np.diff(self.offsets)
+            ends = np.concatenate([self.offsets[1:],
+                                   np.repeat(self.offsets[-1], len(lengths) - n_rows)])
+            self.matrix = np.insert(self.matrix, np.repeat(ends, lengths - current_lengths), 0)
+            self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        def counts(self):
+            """Return the seqids, positions and counts of the counted
+            positions"""
+            index = np.flatnonzero(self.matrix)
+            lengths = np.diff(self.offsets)
+            seqids = np.repeat(np.arange(len(lengths)), lengths)[index]
+            return (seqids, index - self.offsets[seqids], self.matrix[index].astype(np.int64))
+
+        def get(self, seqids, positions):
+            scores = np.zeros(len(positions), dtype=np.int64)
+            lengths = np.diff(self.offsets)
+            valid = seqids < len(lengths)
+            valid[valid] = positions[valid] < lengths[seqids[valid]]
+            scores[valid] = self.matrix[self.offsets[seqids[valid]] + positions[valid]]
+            return scores
 
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
         self.results = {}
+        # Patterns scored by the last build
+        self.updated = set()
         self._ntscore = self._PositionScoreMatrix()
-
-    def build(self, pattern_set, append=False, seqmask=False):
+        # Scored positions of all patterns, as keys (see _position_keys)
+        # and indices into _patterns
+        self._patterns = []
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._owners = np.zeros(0, dtype=np.int64)
+        # Scored patterns covering positions counted since the last build
+        self._stale = set()
+
+    @profiled('PositionScoring.build')
+    def build(self, pattern_set, append=False, seqmask=False, counted=False):
+        """append: pattern_set holds the patterns added since the last
+        build. Their sites are added to the accumulated counts, and of
+        the patterns scored before only the ones covering a position of
+        the new sites are scored again.
+        counted: the sites of pattern_set were already added by count()"""
         assert isinstance(pattern_set, PatternSet)
 
         self._logger.info('building scores')
 
         if not append:
+            self.results = {}
             self._ntscore = self._PositionScoreMatrix()
+            self._patterns = []
+            self._keys = np.zeros(0, dtype=np.int64)
+            self._owners = np.zeros(0, dtype=np.int64)
+            self._stale = set()
+
+        # Patterns already scored are not counted twice
+        patterns = [x for x in pattern_set if x not in self.results]
 
         # Calculate accumulative scores
-        for pattern in pattern_set:
-            for seqid, indices in pattern.matchtable_pset.pos_nonwildcards.iteritems():
-                for index in indices:
-                    self._ntscore.add(seqid, index)
+        positions = {}
+        for pattern in patterns:
+            positions.update({pattern: pattern.matchtable_pset.site_positions(nonwildcards=True)})
+        if not counted:
+            self._count(positions.values())
+        self.updated = self._stale | set(patterns)
+        self._stale = set()
+
+        keys = [self._keys]
+        owners = [self._owners]
+        for pattern in patterns:
+            seqids, indices = self._mask(pattern, positions.get(pattern), seqmask)
+            keys.append(_position_keys(seqids, indices))
+            owners.append(np.repeat(len(self._patterns), len(seqids)))
+            self._patterns.append(pattern)
+        self._keys = np.concatenate(keys)
+        self._owners = np.concatenate(owners)
 
         # Assign scores to each pattern
-        for pattern in pattern_set:
-            match_score = 0
-            for seqid, indices in pattern.matchtable_pset.pos_nonwildcards.iteritems():
-                if seqmask and seqid > pattern.matchtable_pset.n_hitseqs:
-                    continue
-                for index in indices:
-                    for i in index:
-                        match_score += self._ntscore.get(seqid, i)
+        for pattern in self.updated:
+            if pattern in positions:
+                seqids, indices = positions.pop(pattern)
+            else:
+                seqids, indices = pattern.matchtable_pset.site_positions(nonwildcards=True)
+            seqids, indices = self._mask(pattern, (seqids, indices), seqmask)
+            match_score = int(self._ntscore.get(seqids, indices).sum())
 
             score = float(match_score) / (pattern.matchtable_pset.n_hitseqs * pattern.n_nonwildcards)
             self.results.update({pattern: score})
 
         return self
 
+    def count(self, pattern_set):
+        """Add the sites of the patterns to the accumulated counts
+        without scoring them
+
+        The patterns can be scored later by build(counted=True); the
+        others only have to be counted and can then be dropped."""
+        self._count([x.matchtable_pset.site_positions(nonwildcards=True) for x in pattern_set])
+
+        return self
+
+    def coverage(self):
+        """Return the accumulated counts as (seqids, positions, counts)
+        arrays"""
+        return self._ntscore.counts()
+
+    def add_coverage(self, seqids, positions, counts):
+        """Add counts returned by coverage(), e.g. of the sites of
+        patterns scored elsewhere, to the accumulated counts; negative
+        counts remove sites that were counted twice"""
+        self._add(seqids, positions, counts)
+
+        return self
+
+    def _count(self, positions):
+        if not positions:
+            return
+        seqids = np.concatenate([i[0] for i in positions])
+        indices = np.concatenate([i[1] for i in positions])
+        self._add(seqids, indices)
+
+    def _add(self, seqids, indices, weights=None):
+        self._ntscore.add(seqids, indices, weights)
+        if len(self._keys):
+            covered = np.in1d(self._keys, _position_keys(seqids, indices))
+            self._stale.update(self._patterns[i] for i in np.unique(self._owners[covered]))
+
+    def _mask(self, pattern, positions, seqmask):
+        """Keep the positions in the first n_hitseqs sequences when
+        seqmask is set"""
+        seqids, indices = positions
+        if seqmask:
+            mask = seqids <= pattern.matchtable_pset.n_hitseqs
+            seqids = seqids[mask]
+            indices = indices[mask]
+
+        return (seqids, indices)
+
+
+def _position_keys(seqids, indices):
+    """Encode (seqid, index) pairs as single integers"""
+    return (seqids << 32) + indices
+
 
 class NucleosomeOccupancyScoring(object):
     """Calculate the nucleosome occupancy scores of the pattern(s)"""
@@ -97,8 +232,12 @@ class NucleosomeOccupancyScoring(object):
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
         self.results = {}
+        self._scores = None
+        self._score_file = None
 
-    def build(self, pattern_set, score_file=None, append=False):
+    def build(self, pattern_set, score_file=None, append=False, cache=None, sums=None):
+        """sums: the site_sums of the patterns, used instead of
+        score_file"""
         assert isinstance(pattern_set, PatternSet)
 
         self._logger.info('building scores')
@@ -106,18 +245,30 @@ class NucleosomeOccupancyScoring(object):
         if not append:
             self.results = {}
 
-        scores = parse_base_score(score_file, scale=True)
+        if sums is None:
+            sums = self.site_sums(pattern_set, score_file, append, cache)
         for pattern in pattern_set:
-            s = []
-            for seqid, indices in pattern.matchtable_pset.pos_matches.iteritems():
-                if scores.get(seqid):
-                    for index in indices:
-                        for i in index:
-                            s.append(1 - scores.get(seqid).get(i))
-            self.results.update({pattern: float(sum(s)) / len(s)})
+            total, n = sums.get(pattern)
+            self.results.update({pattern: total / n})
 
         return self
 
+    def site_sums(self, pattern_set, score_file=None, append=False, cache=None):
+        """Return the sum and the number of the scores at the sites of
+        each pattern, as a dict of (sum, count)"""
+        # The scores are loaded once for the builds appending patterns
+        if not append or score_file != self._score_file:
+            self._scores = parse_base_score(score_file, scale=True, cache=cache)
+            self._score_file = score_file
+        scores = self._scores
+        sums = {}
+        for pattern in pattern_set:
+            s = scores.gather(*pattern.matchtable_pset.site_positions())
+            s = 1 - s[~np.isnan(s)]
+            sums.update({pattern: _sum(s, pattern)})
+
+        return sums
+
 
 class ConservationScoring(object):
     """Calculate the conservation scores of the pattern(s)"""
@@ -125,8 +276,12 @@ class ConservationScoring(object):
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
         self.results = {}
+        self._scores = None
+        self._score_file = None
 
-    def build(self, pattern_set, score_file=None, append=False):
+    def build(self, pattern_set, score_file=None, append=False, cache=None, sums=None):
+        """sums: the site_sums of the patterns, used instead of
+        score_file"""
         assert isinstance(pattern_set, PatternSet)
 
         self._logger.info('building scores')
@@ -134,19 +289,43 @@ class ConservationScoring(object):
         if not append:
             self.results = {}
 
-        scores = parse_base_score(score_file, scale=False)
+        if sums is None:
+            sums = self.site_sums(pattern_set, score_file, append, cache)
         for pattern in pattern_set:
-            s = []
-            for seqid, indices in pattern.matchtable_pset.pos_matches.iteritems():
-                if scores.get(seqid):
-                    for index in indices:
-                        for i in index:
-                            if scores.get(seqid).get(i):
-                                s.append(scores.get(seqid).get(i))
-            self.results.update({pattern: float(sum(s)) / len(s)})
+            total, n = sums.get(pattern)
+            self.results.update({pattern: total / n})
 
         return self
 
+    def site_sums(self, pattern_set, score_file=None, append=False, cache=None):
+        """Return the sum and the number of the scores at the sites of
+        each pattern, as a dict of (sum, count)"""
+        # The scores are loaded once for the builds appending patterns
+        if not append or score_file != self._score_file:
+            self._scores = parse_base_score(score_file, scale=False, cache=cache)
+            self._score_file = score_file
+        scores = self._scores
+        sums = {}
+        for pattern in pattern_set:
+            s = scores.gather(*pattern.matchtable_pset.site_positions())
+            # Missing and zero scores are left out
+            s = s[~np.isnan(s) & (s != 0)]
+            sums.update({pattern: _sum(s, pattern)})
+
+        return sums
+
+
+def _sum(scores, pattern):
+    """Sum and number of the base scores at the sites of a pattern; the
+    score of the pattern is their mean
+
+    The scores are summed one after another, in the order of the sites,
+    like the built-in sum."""
+    if not len(scores):
+        raise Exception('[_sum] No base scores at the sites of pattern {0}'.format(pattern.sequence))
+
+    return (float(np.cumsum(scores)[-1]), len(scores))
+
 
 class PatternScoring(object):
 
@@ -158,9 +337,82 @@ class PatternScoring(object):
         self._poccur = PreferentialOccurrence()
         self._pscore = PositionScoring()
         self._noscore = NucleosomeOccupancyScoring()
+        self._csscore = ConservationScoring()
+        self._nuclocc = False
+        self._consv = False
+        self._table = None
+        # |z-score| and position score per unit of coverage of the
+        # discarded patterns (see discard)
+        self._discarded = (array('d'), array('d'))
+
+    def count(self, pattern_set):
+        """Count the sites of patterns that are not scored, or scored by
+        a later build(counted=True); see PositionScoring.count"""
+        assert isinstance(pattern_set, PatternSet)
+        self._pscore.count(pattern_set)
+
+        return self
+
+    def coverage(self):
+        """Return the counted positions (see PositionScoring.coverage)"""
+        return self._pscore.coverage()
+
+    def add_coverage(self, seqids, positions, counts):
+        """Add counted positions (see PositionScoring.add_coverage)"""
+        self._pscore.add_coverage(seqids, positions, counts)
+
+        return self
+
+    def discard(self, pattern, z_score):
+        """Record a counted pattern that is left out of scoring, so that
+        discarded_bound can bound its pattern score"""
+        mt_p = pattern.matchtable_pset
+        ratio = 0.0
+        if mt_p.n_hitseqs:
+            n_positions = len(mt_p.site_positions(nonwildcards=True)[0])
+            ratio = float(n_positions) / (mt_p.n_hitseqs * pattern.n_nonwildcards)
+        self._discarded[0].append(abs(z_score))
+        self._discarded[1].append(ratio)
+
+        return self
+
+    def discarded_bound(self):
+        """Return an upper bound of the pattern scores the discarded
+        patterns would get, or None if no pattern was discarded
+
+        The position score of a pattern is at most the highest
+        accumulated count times its number of counted positions per hit
+        sequence and non-wildcard base; the occupancy scores are at most
+        1 and the conservation scores at most the largest base score.
+        With a negative weight there is no bound (inf)."""
+        if not len(self._discarded[0]):
+            return None
+        if min(self.sp_weight, self.sn_weight, self.sc_weight) < 0:
+            return float('inf')
+
+        z_scores = np.frombuffer(self._discarded[0])
+        ratios = np.frombuffer(self._discarded[1])
+        counts = self.coverage()[2]
+        max_count = float(counts.max()) if len(counts) else 0.0
+        bound = float((z_scores * (ratios * max_count) ** self.sp_weight).max())
+        if self._consv and self.sc_weight:
+            if self._csscore._scores is None:
+                return float('inf')
+            bound *= float(np.nanmax(np.abs(self._csscore._scores.data))) ** self.sc_weight
+
+        return bound
 
     def build(self, pattern_set, append=False, seqmask=False, nuclocc=None,
-              consv=None):
+              consv=None, score_cache=None, counted=False, nuclocc_sums=None,
+              consv_sums=None):
+        """append: pattern_set holds the patterns added since the last
+        build; only the patterns whose position scores changed (see
+        PositionScoring.build) get a new pattern score
+        counted: the sites of pattern_set were already added by count()
+        or add_coverage()
+        nuclocc_sums, consv_sums: the site_sums of the occupancy and
+        conservation scores of the patterns, used instead of nuclocc and
+        consv"""
         assert isinstance(pattern_set, PatternSet)
 
         if not append:
@@ -169,57 +421,219 @@ class PatternScoring(object):
             self._pscore = PositionScoring()
             self._noscore = NucleosomeOccupancyScoring()
             self._csscore = ConservationScoring()
+            self._discarded = (array('d'), array('d'))
+
+        self._nuclocc = bool(nuclocc) or nuclocc_sums is not None
+        self._consv = bool(consv) or consv_sums is not None
+        self._table = None
 
         self._poccur.build(pattern_set, append)
-        self._pscore.build(pattern_set, append, seqmask)
-        if nuclocc:
-            self._noscore.build(pattern_set, score_file=nuclocc, append=append)
-        if consv:
-            self._csscore.build(pattern_set, score_file=consv, append=append)
-
-        for pattern, score in self._poccur.results.iteritems():
-            pattern_score = score
+        self._pscore.build(pattern_set, append, seqmask, counted)
+        if self._nuclocc:
+            self._noscore.build(pattern_set, score_file=nuclocc, append=append,
+                                cache=score_cache, sums=nuclocc_sums)
+        if self._consv:
+            self._csscore.build(pattern_set, score_file=consv, append=append,
+                                cache=score_cache, sums=consv_sums)
+
+        for pattern in self._pscore.updated:
+            pattern_score = self._poccur.results.get(pattern)
             pattern_score *= self._pscore.results.get(pattern) ** self.sp_weight
-            if nuclocc:
+            if self._nuclocc:
                 pattern_score *= self._noscore.results.get(pattern) ** self.sn_weight
-            if consv:
+            if self._consv:
                 pattern_score *= self._csscore.results.get(pattern) ** self.sc_weight
 
             self.results.update({pattern: pattern_score})
 
         return self
 
+    def table(self):
+        """Return the component scores of the scored patterns as a
+        columnar table: a dict of the patterns (in sequence order) and
+        NumPy arrays of their z_score, position, occupancy and
+        conservation scores (None for the components not scored)"""
+        if self._table is None:
+            patterns = sorted(self.results, key=lambda x: x.sequence)
+            columns = [
+                ('z_score', self._poccur, True),
+                ('position', self._pscore, True),
+                ('occupancy', self._noscore, self._nuclocc),
+                ('conservation', self._csscore, self._consv),
+            ]
+            self._table = {'pattern': patterns}
+            for name, scorer, scored in columns:
+                if scored:
+                    self._table.update({name: np.array(
+                        [scorer.results.get(x) for x in patterns], dtype=np.float64)})
+                else:
+                    self._table.update({name: None})
 
-def parse_base_score(fpath, scale=False):
-    """Parse the base-based score data"""
-    if isinstance(fpath, str):
-        fi = open(fpath, 'r')
-    else:
-        return None
+        return self._table
 
-    scores = {}
-    for line in fi:
-        data = line.strip().split('\t')
-        if data[4] == '-':
-            continue
-        seqid = int(data[0])
-        index = int(data[1]) - 1
-        score = float(data[4])
-        if seqid in scores:
-            scores.get(seqid).update({index: score})
-        else:
-            scores.update({seqid: {index: score}})
+    def reweight(self, sp_weight=1, sn_weight=1, sc_weight=1):
+        """Recompute the pattern scores of every scored pattern with
+        other weights, from the component scores of the last build"""
+        table = self.table()
+        self.sp_weight = sp_weight
+        self.sn_weight = sn_weight
+        self.sc_weight = sc_weight
+
+        pattern_scores = table.get('z_score') * table.get('position') ** sp_weight
+        if self._nuclocc:
+            pattern_scores *= table.get('occupancy') ** sn_weight
+        if self._consv:
+            pattern_scores *= table.get('conservation') ** sc_weight
 
-    fi.close()
+        self.results = dict(zip(table.get('pattern'), pattern_scores.tolist()))
+
+        return self
+
+
+class BaseScores(object):
+    """Per-base scores of a sequence set
+
+    The scores of all sequences are kept in one flat float array; the
+    scores of seqid k occupy data[offsets[i]:offsets[i + 1]] where
+    seqids[i] == k. Bases without a score are NaN."""
+
+    def __init__(self, seqids, offsets, data):
+        self.seqids = seqids
+        self.offsets = offsets
+        self.data = data
+        self._index = dict((seqid, i) for i, seqid in enumerate(seqids))
+        # Row of each seqid, -1 for the sequences without scores
+        self._rows = -np.ones(max(seqids) + 1 if seqids else 0, dtype=np.int64)
+        self._rows[seqids] = np.arange(len(seqids))
+
+    def __len__(self):
+        return len(self.seqids)
+
+    def __contains__(self, seqid):
+        return seqid in self._index
+
+    def get(self, seqid):
+        """Return the scores of a sequence, or None"""
+        i = self._index.get(seqid)
+        if i is None:
+            return None
+        return self.data[self.offsets[i]: self.offsets[i + 1]]
+
+    def gather(self, seqids, positions):
+        """Return the scores at (seqids, positions); NaN where there is
+        no score"""
+        rows = -np.ones(len(seqids), dtype=np.int64)
+        known = seqids < len(self._rows)
+        rows[known] = self._rows[seqids[known]]
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        valid = (rows >= 0) & (positions >= 0) & (positions < lengths)
+        scores = np.empty(len(positions))
+        scores[:] = np.nan
+        scores[valid] = self.data[starts[valid] + positions[valid]]
+        return scores
+
+    def scaled(self):
+        """Return a copy with the scores of each sequence scaled to
+        [0, 1]"""
+        if not self.seqids:
+            return self
+        lengths = np.diff(self.offsets)
+        min_scores = np.repeat(np.fmin.reduceat(self.data, self.offsets[:-1]), lengths)
+        max_scores = np.repeat(np.fmax.reduceat(self.data, self.offsets[:-1]), lengths)
+        data = (self.data - min_scores) / (max_scores - min_scores)
+        return BaseScores(self.seqids, self.offsets, data)
+
+    def save(self, fpath):
+        """Save the scores in a binary file that load maps into memory
+
+        The file holds a single float64 array: the number of sequences,
+        the seqids, the offsets and then the scores."""
+        # Write a temporary file first so that concurrent runs never read
+        # a partial file
+        tmp_fpath = '{0}.{1}.tmp'.format(fpath, os.getpid())
+        with open(tmp_fpath, 'wb') as fo:
+            np.save(fo, np.concatenate([[len(self.seqids)], self.seqids, self.offsets, self.data]))
+        os.rename(tmp_fpath, fpath)
+
+    @classmethod
+    def load(cls, fpath):
+        """Load the scores saved by save; the scores are memory-mapped"""
+        values = np.load(fpath, mmap_mode='r')
+        n_seqs = int(values[0])
+        seqids = [int(i) for i in values[1: n_seqs + 1]]
+        offsets = np.array(values[n_seqs + 1: 2 * n_seqs + 2], dtype=np.int64)
+        return cls(seqids, offsets, values[2 * n_seqs + 2:])
+
+
+@profiled('parse_base_score')
+def parse_base_score(fpath, scale=False, cache=None):
+    """Parse the base-based score data into BaseScores
+
+    cache: a directory in which the parsed scores are kept in binary
+    files and mapped into memory on the next runs. An entry is keyed by
+    the absolute path, the modification time and the size of the score
+    file, so a changed score file gets a new entry (the old one is left
+    in the directory); nothing is written next to the score files."""
+    if isinstance(fpath, BaseScores):
+        scores = fpath
+    elif isinstance(fpath, str):
+        cache_fpath = _score_cache_fpath(cache, fpath) if cache else None
+        if cache_fpath and os.path.exists(cache_fpath):
+            scores = BaseScores.load(cache_fpath)
+        else:
+            scores = _parse_base_score(fpath)
+            if cache_fpath:
+                scores.save(cache_fpath)
+    else:
+        return None
 
     # Scale score range to [0, 1]
     if scale:
-        for seqid, score in scores.iteritems():
-            values = score.values()
-            min_score = min(values)
-            max_score = max(values)
-            interval = max_score - min_score
-            for i, j in score.iteritems():
-                score[i] = (j - min_score) / interval
+        scores = scores.scaled()
 
     return scores
+
+
+def _score_cache_fpath(cache, fpath):
+    """Return the path of the cache entry of a score file"""
+    try:
+        os.makedirs(cache)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    stat = os.stat(fpath)
+    digest = hashlib.sha1()
+    digest.update('{0}\t{1!r}\t{2}'.format(os.path.abspath(fpath), stat.st_mtime, stat.st_size))
+    return os.path.join(cache, digest.hexdigest() + '.npy')
+
+
+def _parse_base_score(fpath):
+    count('score_bytes_parsed', os.path.getsize(fpath))
+
+    seqids = array('l')
+    indices = array('l')
+    values = array('d')
+    with open(fpath, 'r') as fi:
+        for line in fi:
+            data = line.strip().split('\t')
+            if data[4] == '-':
+                continue
+            seqids.append(int(data[0]))
+            indices.append(int(data[1]) - 1)
+            values.append(float(data[4]))
+
+    seqids = np.frombuffer(seqids, dtype=np.int_)
+    indices = np.frombuffer(indices, dtype=np.int_)
+    values = np.frombuffer(values, dtype=np.float64)
+
+    unique_seqids, rows = np.unique(seqids, return_inverse=True)
+    lengths = np.zeros(len(unique_seqids), dtype=np.int64)
+    np.maximum.at(lengths, rows, indices + 1)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    data = np.empty(offsets[-1])
+    data[:] = np.nan
+    # Later lines override earlier ones, as in a dict
+    data[offsets[rows] + indices] = values
+
+    return BaseScores([int(i) for i in unique_seqids], offsets, data)
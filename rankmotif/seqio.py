@@ -1,3 +1,8 @@
+import zlib
+import hashlib
+from array import array
+
+
 def revcomp(sequence):
     """Convert a DNA sequence into its reverse-complement
     counterpart"""
@@ -25,76 +30,183 @@ def revcomp(sequence):
 
 
 def parse_fasta(handle):
-    """handle: path to FASTA file or file object"""
-    is_path = False
-    if isinstance(handle, str):
-        is_path = True
-        fi = open(handle, 'r')
-    else:
-        fi = handle
+    """Yield the (header, sequence) records of a FASTA file; the header
+    is the text after '>' up to the first space
+
+    handle: path to FASTA file or file object, plain or gzip (bgzip)
+    compressed"""
+    return _parse_fasta(handle, lambda x: x.split(' ')[0])
+
+
+def parse_fasta_noheader(handle):
+    """Yield the sequences of a FASTA file
+
+    handle: path to FASTA file or file object, plain or gzip (bgzip)
+    compressed"""
+    for header, sequence in _parse_fasta(handle, lambda x: x):
+        yield sequence
 
+
+def _parse_fasta(handle, header_name):
+    """A record is only yielded when it has a header and a sequence; the
+    sequence lines of a record without them go to the next record"""
     header = ''
     sequence = []
-    while 1:
-        line = fi.readline()
-        if line == '':
+    for is_header, text in _fasta_tokens(handle):
+        if is_header:
             if header and sequence:
                 yield (header, ''.join(sequence))
-            break
+                sequence = []
+            header = header_name(text)
+        else:
+            sequence.append(text)
+
+    if header and sequence:
+        yield (header, ''.join(sequence))
+
+
+# Size of the blocks FASTA files are read in
+BLOCK_SIZE = 16777216
+
+
+def _fasta_tokens(handle):
+    """Yield the header lines (True, text after '>') and the sequence
+    chunks (False, sequence) of a FASTA file
+
+    Records are split at '\\n>' and the sequence lines of a record are
+    joined at once when they hold nothing but letters; other records
+    (with spaces, '\\r', ...) are tokenized line by line, each line
+    stripped and blank lines skipped."""
+    for block in _fasta_blocks(handle):
+        for i, part in enumerate(block.split('\n>')):
+            if i or part[:1] == '>':
+                end = part.find('\n')
+                if end < 0:
+                    end = len(part)
+                yield (True, part[0 if i else 1:end].rstrip())
+                part = part[end + 1:]
+
+            sequence = part.replace('\n', '')
+            if sequence.isalpha():
+                yield (False, sequence)
+            elif sequence:
+                for line in part.split('\n'):
+                    line = line.strip()
+                    if line == '':
+                        continue
+                    elif line[0] == '>':
+                        yield (True, line[1:])
+                    else:
+                        yield (False, line)
+
 
-        line = line.strip()
-        if line == '':
+def _fasta_blocks(handle):
+    """Yield the content of a FASTA file in blocks cut before a record
+    start ('\\n>'), so that no record is split across blocks"""
+    pending = []
+    for block in _read_blocks(handle):
+        if not block:
             continue
-        elif line[0] == '>':
-            if header and sequence:
-                yield (header, ''.join(sequence))
-                header = line[1:].split(' ')[0]
-                sequence = []
-            else:
-                header = line[1:].split(' ')[0]
+        end = block.rfind('\n>')
+        if end >= 0:
+            pending.append(block[:end])
+            yield ''.join(pending)
+            pending = [block[end + 1:]]
+        elif block[0] == '>' and pending and pending[-1][-1:] == '\n':
+            # '\n>' across two blocks
+            yield ''.join(pending)[:-1]
+            pending = [block]
         else:
-            sequence.append(line)
+            pending.append(block)
 
-    if is_path:
-        fi.close()
+    rest = ''.join(pending)
+    if rest:
+        yield rest
 
 
-def parse_fasta_noheader(handle):
-    """handle: path to FASTA file or file object"""
+def _read_blocks(handle):
+    """Yield the content of a file in blocks of BLOCK_SIZE bytes,
+    decompressing gzip files (including the multi-member files of
+    bgzip) as a stream"""
     is_path = False
     if isinstance(handle, str):
         is_path = True
-        fi = open(handle, 'r')
+        fi = open(handle, 'rb')
     else:
         fi = handle
 
-    header = ''
-    sequence = []
-    while 1:
-        line = fi.readline()
-        if line == '':
-            if header and sequence:
-                yield ''.join(sequence)
-            break
+    try:
+        # At least the two bytes of the gzip magic number
+        block = fi.read(max(BLOCK_SIZE, 2))
+        if block[:2] != '\x1f\x8b':
+            while block:
+                yield block
+                block = fi.read(BLOCK_SIZE)
+            return
 
-        line = line.strip()
-        if line == '':
-            continue
-        elif line[0] == '>':
-            if header and sequence:
-                yield ''.join(sequence)
-                header = line[1:]
-                sequence = []
-            else:
-                header = line[1:]
-        else:
-            sequence.append(line)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while block:
+            while block:
+                yield decompressor.decompress(block)
+                block = decompressor.unused_data
+                if block:
+                    # The next member of a multi-member file
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            block = fi.read(BLOCK_SIZE)
+        yield decompressor.flush()
+    finally:
+        if is_path:
+            fi.close()
 
-    if is_path:
-        fi.close()
+
+class SequenceSet(object):
+    """Sequences of a FASTA file loaded once and kept in memory
+
+    All sequences are lowercased and concatenated into a single buffer;
+    the sequence with seqid k (1-based, in file order) occupies
+    data[offsets[k - 1]:offsets[k]]."""
+
+    def __init__(self, handle):
+        self.gene_names = []
+        self.offsets = array('l', [0])
+
+        chunks = []
+        for gene_name, sequence in parse_fasta(handle):
+            self.gene_names.append(gene_name)
+            chunks.append(sequence.lower())
+            self.offsets.append(self.offsets[-1] + len(sequence))
+        self.data = ''.join(chunks)
+        self._fingerprint = None
+
+    def __len__(self):
+        return len(self.gene_names)
+
+    def __iter__(self):
+        for seqid in xrange(1, len(self.gene_names) + 1):
+            yield (self.gene_names[seqid - 1], self.sequence(seqid))
+
+    def sequence(self, seqid):
+        return self.data[self.offsets[seqid - 1]: self.offsets[seqid]]
+
+    def gene_name(self, seqid):
+        return self.gene_names[seqid - 1]
+
+    def fingerprint(self):
+        """Return the SHA-1 digest of the gene names and the sequences"""
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            digest.update('\n'.join(self.gene_names))
+            digest.update(self.offsets.tostring())
+            digest.update(self.data)
+            self._fingerprint = digest.hexdigest()
+
+        return self._fingerprint
 
 
 def gc_content(fpath):
+    if isinstance(fpath, SequenceSet):
+        return float(fpath.data.count('g') + fpath.data.count('c')) / len(fpath.data)
+
     gc_count = 0
     total = 0
     for i in parse_fasta_noheader(fpath):
@@ -0,0 +1,176 @@
+import os
+import json
+import signal
+import logging
+import BaseHTTPServer
+import SocketServer
+from multiprocessing import Pool
+from .pipeline import Dataset, rank, collect_results, write_results
+
+# Dataset and options shared with the worker processes
+_worker_args = {}
+
+
+def _integer(minimum):
+    def check(value):
+        return isinstance(value, (int, long)) and not isinstance(value, bool) and value >= minimum
+    return check
+
+
+def _fraction(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool) and \
+        0 < value < 1
+
+
+# Ranking options of a job: the argument of rank, the default, how the
+# value is checked and what it must be
+OPTIONS = {
+    'sp': ('sp_weight', 1, _integer(0), 'a non-negative integer'),
+    'sn': ('sn_weight', 1, _integer(0), 'a non-negative integer'),
+    'sc': ('sc_weight', 1, _integer(0), 'a non-negative integer'),
+    'nc': ('max_cluster', 5, _integer(1), 'a positive integer'),
+    'np': ('max_patterns_per_cluster', 5, _integer(1), 'a positive integer'),
+    'ws': ('simpfm_max_wsize', None, _integer(1), 'a positive integer'),
+    'gc': ('gc', None, _fraction, 'a number between 0 and 1'),
+    'seqmask': ('seqmask', 'no', lambda x: x in ['yes', 'no'], 'yes or no'),
+    'prefilter': ('prefilter', None, _integer(1), 'a positive integer'),
+}
+
+
+def _init_worker(dataset, out, options):
+    # Interrupting the server stops the pool from the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_args.update({
+        'dataset': dataset,
+        'out': out,
+        'options': options,
+    })
+
+
+def _rank_worker(request):
+    dataset = _worker_args.get('dataset')
+
+    for key in request:
+        if key not in OPTIONS and key not in ['patterns', 'seqtype', 'out']:
+            raise Exception('[RankingServer] Unknown field: {0}'.format(key))
+    if not isinstance(request.get('patterns'), list):
+        raise Exception('[RankingServer] A list of patterns is required')
+    if request.get('seqtype') not in ['dna', 'rna']:
+        raise Exception('[RankingServer] Sequence type must be dna or rna')
+    reverse_complement = request.get('seqtype') == 'dna'
+
+    options = {}
+    for key, (argument, default, check, expected) in OPTIONS.iteritems():
+        value = request.get(key)
+        if value is None:
+            value = default
+        elif not check(value):
+            raise Exception('[RankingServer] {0} must be {1}: {2}'.format(
+                key, expected, json.dumps(value)))
+        options.update({argument: value})
+    options.update({'seqmask': options.get('seqmask') == 'yes'})
+
+    out = None
+    if request.get('out') is not None:
+        out = _out_path(request.get('out'))
+
+    cluster = rank(dataset, [str(i).strip() for i in request.get('patterns')], reverse_complement,
+                   **dict(options, **_worker_args.get('options')))
+    results = collect_results(cluster, dataset.pset, reverse_complement)
+    if out:
+        write_results(results, out)
+
+    return results
+
+
+def _out_path(out):
+    """Return the path of the out directory of a job, which must be
+    inside the output directory of the server"""
+    out_dir = _worker_args.get('out')
+    if out_dir is None:
+        raise Exception('[RankingServer] The server writes no result files (see -out)')
+    if not isinstance(out, basestring) or not out:
+        raise Exception('[RankingServer] out must be a directory name')
+    root = os.path.realpath(out_dir)
+    path = os.path.realpath(os.path.join(root, out))
+    if path == root or not path.startswith(root + os.sep):
+        raise Exception('[RankingServer] out must be inside the output directory of the '
+                        'server: {0}'.format(out))
+    return path
+
+
+class RankingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server ranking pattern lists against a Dataset kept in
+    memory
+
+    A job is a POST to /rank with a JSON object holding the patterns
+    and the ranking options of rankMotif.py:
+
+        {"patterns": ["acgtnnacgt", ...], "seqtype": "dna", "sp": 1,
+         "sn": 1, "sc": 1, "nc": 5, "np": 5, "ws": null, "gc": null,
+         "seqmask": "no", "prefilter": null, "out": "<dir>"}
+
+    Only patterns and seqtype are required. The options are checked as
+    rankMotif.py checks them, and a job with an invalid one is answered
+    with 400 and an error message. With out, the result files of
+    rankMotif.py are also written into that directory, taken relative
+    to the out directory of the server; a server without one writes no
+    files. The response is a JSON object whose results are the tables of
+    collect_results.
+
+    Requests are served by threads and the jobs are run by a pool of
+    worker processes forked after the Dataset is loaded.
+    out: the directory the jobs may write their result files into
+    options: engine, compact and cache of the jobs (see rank)"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, dataset, address=('127.0.0.1', 8000), workers=1, out=None, **options):
+        assert isinstance(dataset, Dataset)
+        assert workers > 0
+        BaseHTTPServer.HTTPServer.__init__(self, address, _RequestHandler)
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.pool = Pool(workers, _init_worker, (dataset, out, options))
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path != '/rank':
+            self._send(404, {'error': 'Unknown path: {0}'.format(self.path)})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        except ValueError:
+            self._send(400, {'error': 'Invalid JSON request'})
+            return
+        if not isinstance(request, dict):
+            self._send(400, {'error': 'Invalid JSON request'})
+            return
+
+        try:
+            results = self.server.pool.apply(_rank_worker, (request,))
+        except Exception as e:
+            self.server._logger.error(str(e))
+            self._send(400, {'error': str(e)})
+            return
+
+        self._send(200, {'results': results})
+
+    def _send(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server._logger.info('{0} {1}'.format(self.address_string(), format % args))
@@ -0,0 +1,287 @@
+import os
+import json
+import logging
+import numpy as np
+from .basic import Pattern, PatternSet, MatchTable
+from .indexing import build_matchtables
+from .scoring import (PatternScoring, PositionScoring, NucleosomeOccupancyScoring,
+                      ConservationScoring)
+from .pipeline import Dataset
+from .profiling import stage
+from .seqio import revcomp
+
+# Bumped whenever the layout of the shard files changes
+SHARD_VERSION = 1
+
+
+def shard_range(n_items, shard, n_shards):
+    """Return the [start, stop) range of the items of shard (1-based) when
+    n_items are split into n_shards contiguous slices"""
+    if not 0 < shard <= n_shards:
+        raise Exception('[shard_range] Invalid shard: {0}/{1}'.format(shard, n_shards))
+    return (n_items * (shard - 1) // n_shards, n_items * shard // n_shards)
+
+
+class ShardState(object):
+    """Partial scoring state of a slice of a pattern list
+
+    The state holds what a map job computes from its patterns alone:
+
+        meta: shard and n_shards, reverse_complement, whether occupancy
+        and conservation scores were summed, and the fingerprints of
+        the positive and the negative set
+        sequences: the pattern sequences as listed (Pattern counts the
+        wildcards of these), without redundant ones (see PatternSet)
+        counts: n_seqs, n_hitseqs and n_hitsites of the positive set
+        and n_seqs and n_hitseqs of the negative set, per pattern
+        site_offsets, seqids, starts, strands: the positive-set sites of
+        pattern k (see MatchTable.sites) are
+        [site_offsets[k], site_offsets[k + 1])
+        coverage: the positions covered by the non-wildcard bases of all
+        sites, as (seqids, positions, counts) (see
+        PositionScoring.coverage)
+        occupancy, conservation: the sum and the number of the scores
+        at the sites of each pattern (see site_sums), or None
+
+    A state is saved into a single compressed .npz file."""
+
+    def __init__(self, meta, sequences, counts, site_offsets, seqids, starts, strands,
+                 coverage, occupancy=None, conservation=None):
+        self.meta = meta
+        self.sequences = sequences
+        self.counts = counts
+        self.site_offsets = site_offsets
+        self.seqids = seqids
+        self.starts = starts
+        self.strands = strands
+        self.coverage = coverage
+        self.occupancy = occupancy
+        self.conservation = conservation
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def sites(self, k):
+        """Return the sites of pattern k as (seqids, starts, strands)"""
+        start, stop = self.site_offsets[k], self.site_offsets[k + 1]
+        return (self.seqids[start: stop], self.starts[start: stop], self.strands[start: stop])
+
+    def save(self, fpath):
+        arrays = {
+            'meta': np.array(json.dumps(dict(self.meta, version=SHARD_VERSION), sort_keys=True)),
+            'sequences': np.array(self.sequences, dtype='S'),
+            'counts': self.counts,
+            'site_offsets': self.site_offsets,
+            'seqids': self.seqids,
+            'starts': self.starts,
+            'strands': self.strands,
+            'coverage': np.vstack(self.coverage),
+        }
+        if self.occupancy is not None:
+            arrays.update({'occupancy': self.occupancy})
+        if self.conservation is not None:
+            arrays.update({'conservation': self.conservation})
+
+        # Write a temporary file first so that a reduce job never reads a
+        # partial shard
+        tmp_fpath = '{0}.{1}.tmp'.format(fpath, os.getpid())
+        with open(tmp_fpath, 'wb') as fo:
+            np.savez_compressed(fo, **arrays)
+        os.rename(tmp_fpath, fpath)
+
+    @classmethod
+    def load(cls, fpath):
+        arrays = np.load(fpath)
+        meta = json.loads(arrays['meta'].item())
+        if meta.pop('version') != SHARD_VERSION:
+            raise Exception('[ShardState] Unsupported shard file: {0}'.format(fpath))
+        coverage = arrays['coverage']
+        return cls(meta, arrays['sequences'].tolist(), arrays['counts'], arrays['site_offsets'],
+                   arrays['seqids'], arrays['starts'], arrays['strands'],
+                   (coverage[0], coverage[1], coverage[2]),
+                   arrays['occupancy'] if 'occupancy' in arrays else None,
+                   arrays['conservation'] if 'conservation' in arrays else None)
+
+
+def map_shard(dataset, sequences, shard, n_shards, reverse_complement=False, engine='kmer',
+              cpu=1, compact=False, cache=None):
+    """Build the match tables of the pattern sequences of one shard
+    against a Dataset and return their ShardState
+
+    sequences: the pattern sequences of the shard, a slice of the
+    pattern list (see shard_range)
+    engine, cpu, compact, cache: options of build_matchtables"""
+    assert isinstance(dataset, Dataset)
+    logger = logging.getLogger('map_shard')
+
+    pattern_set = PatternSet(reverse_complement)
+    listed = {}
+    for sequence in sequences:
+        pattern = Pattern(sequence)
+        pattern_set.add(pattern)
+        listed.update({pattern: sequence})
+    patterns = list(pattern_set)
+
+    with stage('matchtables'):
+        logger.info('building match tables of {0} patterns (shard {1}/{2})'.format(
+            len(patterns), shard, n_shards))
+        build_matchtables(pattern_set, dataset.pset, dataset.nset, engine=engine, cpu=cpu,
+                          compact=compact, cache=cache)
+
+    with stage('scoring'):
+        logger.info('counting sites')
+        coverage = PositionScoring().count(pattern_set).coverage()
+
+        occupancy = None
+        if dataset.oc:
+            sums = NucleosomeOccupancyScoring().site_sums(pattern_set, dataset.oc)
+            occupancy = np.array([sums.get(x) for x in patterns], dtype=np.float64)
+        conservation = None
+        if dataset.cs:
+            sums = ConservationScoring().site_sums(pattern_set, dataset.cs)
+            conservation = np.array([sums.get(x) for x in patterns], dtype=np.float64)
+
+        counts = np.array([
+            [x.matchtable_pset.n_seqs, x.matchtable_pset.n_hitseqs, x.matchtable_pset.n_hitsites,
+             x.matchtable_nset.n_seqs, x.matchtable_nset.n_hitseqs] for x in patterns],
+            dtype=np.int64).reshape(-1, 5)
+        sites = [x.matchtable_pset.sites() for x in patterns]
+        site_offsets = np.cumsum([0] + [len(i[0]) for i in sites]).astype(np.int64)
+
+    meta = {
+        'shard': shard,
+        'n_shards': n_shards,
+        'reverse_complement': reverse_complement,
+        'occupancy': occupancy is not None,
+        'conservation': conservation is not None,
+        'pset': dataset.pset.fingerprint(),
+        'nset': dataset.nset.fingerprint(),
+    }
+
+    return ShardState(meta, [listed.get(x) for x in patterns], counts, site_offsets,
+                      *[_concatenate([i[k] for i in sites]) for k in xrange(3)],
+                      coverage=coverage, occupancy=occupancy, conservation=conservation)
+
+
+def _concatenate(arrays):
+    if not arrays:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(arrays)
+
+
+def reduce_shards(dataset, states, sp_weight=1, sn_weight=1, sc_weight=1, seqmask=False,
+                  compact=False):
+    """Merge the ShardStates of all shards of a pattern list and return
+    the PatternScoring of its patterns, the same as score_patterns
+    returns for the whole list
+
+    The match tables of the positive set are rebuilt from the sites of
+    the states (compact ones with compact); the ones of the negative set
+    only hold the hit counts. As in PatternSet, a pattern of a later
+    shard replaces one of an earlier shard with the same sequence (or
+    reverse complement); the sites of the replaced pattern are removed
+    from the merged coverage."""
+    assert isinstance(dataset, Dataset)
+    logger = logging.getLogger('reduce_shards')
+
+    states = sorted(states, key=lambda x: x.meta.get('shard'))
+    _check_states(dataset, states)
+    reverse_complement = states[0].meta.get('reverse_complement')
+
+    pattern_scoring = PatternScoring(sp_weight=sp_weight, sn_weight=sn_weight,
+                                     sc_weight=sc_weight)
+    occupancy = {}
+    conservation = {}
+    # Patterns by sequence (or reverse complement), as in PatternSet
+    patterns = {}
+    n_replaced = 0
+
+    with stage('matchtables'):
+        logger.info('merging {0} shards'.format(len(states)))
+        for state in states:
+            pattern_scoring.add_coverage(*state.coverage)
+            for k in xrange(len(state)):
+                pattern = _restore_pattern(dataset, state, k, reverse_complement, compact)
+
+                key = pattern.sequence
+                if reverse_complement and key not in patterns and revcomp(key) in patterns:
+                    key = revcomp(key)
+                if key in patterns:
+                    n_replaced += 1
+                    seqids, positions = patterns.get(key).matchtable_pset.site_positions(
+                        nonwildcards=True)
+                    pattern_scoring.add_coverage(
+                        seqids, positions, -np.ones(len(positions), dtype=np.int64))
+                patterns.update({key: pattern})
+
+                if state.occupancy is not None:
+                    total, n = state.occupancy[k]
+                    occupancy.update({pattern: (float(total), int(n))})
+                if state.conservation is not None:
+                    total, n = state.conservation[k]
+                    conservation.update({pattern: (float(total), int(n))})
+
+        logger.info('merged {0} patterns ({1} replaced by later shards)'.format(
+            len(patterns), n_replaced))
+
+    pattern_set = PatternSet(reverse_complement)
+    for pattern in patterns.itervalues():
+        pattern_set.add(pattern)
+
+    if not states[0].meta.get('occupancy'):
+        occupancy = None
+    if not states[0].meta.get('conservation'):
+        conservation = None
+
+    with stage('scoring'):
+        # The merged coverage is kept by appending to the empty scoring
+        pattern_scoring.build(pattern_set, append=True, seqmask=seqmask, counted=True,
+                              nuclocc_sums=occupancy, consv_sums=conservation)
+
+    return pattern_scoring
+
+
+def _restore_pattern(dataset, state, k, reverse_complement, compact):
+    """Return pattern k of a ShardState with its match tables"""
+    pattern = Pattern(state.sequences[k])
+    pset_n_seqs, pset_n_hitseqs, n_hitsites, nset_n_seqs, nset_n_hitseqs = \
+        state.counts[k].tolist()
+
+    mt_p = MatchTable(reverse_complement, compact)
+    mt_p.reset(dataset.pset)
+    mt_p.add_sites(pattern.sequence, dataset.pset, *state.sites(k))
+    mt_p.n_seqs = pset_n_seqs
+    mt_p.n_hitseqs = pset_n_hitseqs
+    mt_p.n_hitsites = n_hitsites
+
+    mt_n = MatchTable(reverse_complement, compact, count_only=True)
+    mt_n.n_seqs = nset_n_seqs
+    mt_n.n_hitseqs = nset_n_hitseqs
+
+    pattern.matchtable_pset = mt_p
+    pattern.matchtable_nset = mt_n
+    return pattern
+
+
+def _check_states(dataset, states):
+    """Check that the states are the shards of one map over the Dataset"""
+    if not states:
+        raise Exception('[reduce_shards] No shards')
+
+    meta = states[0].meta
+    n_shards = meta.get('n_shards')
+    shards = [x.meta.get('shard') for x in states]
+    if shards != range(1, n_shards + 1):
+        missing = sorted(set(xrange(1, n_shards + 1)) - set(shards))
+        raise Exception('[reduce_shards] Expected shards 1-{0}, missing: {1}, given: {2}'.format(
+            n_shards, missing, shards))
+
+    for state in states:
+        for key in ['n_shards', 'reverse_complement', 'occupancy', 'conservation']:
+            if state.meta.get(key) != meta.get(key):
+                raise Exception('[reduce_shards] Shard {0} differs in {1}'.format(
+                    state.meta.get('shard'), key))
+        if state.meta.get('pset') != dataset.pset.fingerprint() or \
+                state.meta.get('nset') != dataset.nset.fingerprint():
+            raise Exception('[reduce_shards] Shard {0} was mapped over other sequence '
+                            'sets'.format(state.meta.get('shard')))